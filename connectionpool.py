@@ -0,0 +1,64 @@
+# Fixed-size set of IMAP connections that can run commands in parallel (one
+# per connection at a time), so that large fetches are not limited by the
+# round-trip time of a single connection.
+
+import imaplib
+import Queue
+import sys
+import threading
+
+class ConnectionPool(object):
+  def __init__(self, connections):
+    self.__connections = connections
+
+  def GetSize(self):
+    return len(self.__connections)
+
+  def SelectMailbox(self, mailbox):
+    for connection in self.__connections:
+      r, data = connection.select(mailbox)
+      if r != "OK":
+        raise imaplib.IMAP4.error("SELECT command error: %s %s" % (r, data))
+
+  def Map(self, function, items):
+    '''Calls function(connection, item) for each item, spreading the calls
+    across the pool's connections. Results are returned in the same order as
+    the items.'''
+    results = [None] * len(items)
+    errors = []
+
+    pending_items = Queue.Queue()
+    for i, item in enumerate(items):
+      pending_items.put((i, item))
+
+    def ProcessItems(connection):
+      while not errors:
+        try:
+          i, item = pending_items.get_nowait()
+        except Queue.Empty:
+          return
+
+        try:
+          results[i] = function(connection, item)
+        except:
+          errors.append(sys.exc_info())
+
+    threads = [
+      threading.Thread(target=ProcessItems, args=(connection,))
+      for connection in self.__connections
+    ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    if errors:
+      error_type, error_value, error_traceback = errors[0]
+      raise error_type, error_value, error_traceback
+
+    return results
+
+  def Logout(self):
+    for connection in self.__connections:
+      connection.close()
+      connection.logout()
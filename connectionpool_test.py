@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import imaplib
+import threading
+import unittest
+
+import connectionpool
+import fakeimapserver
+
+class ConnectionPoolTest(unittest.TestCase):
+  _CONNECTION_COUNT = 3
+
+  def setUp(self):
+    self.__server = fakeimapserver.FakeImapServer({"INBOX": []})
+    self.__server.Start()
+
+    host, port = self.__server.server_address
+    self.__connections = []
+    for i in xrange(self._CONNECTION_COUNT):
+      connection = imaplib.IMAP4(host, port)
+      connection.login("user", "password")
+      self.__connections.append(connection)
+    self.__pool = connectionpool.ConnectionPool(self.__connections)
+
+  def tearDown(self):
+    for connection in self.__connections:
+      if connection.state != "LOGOUT":
+        connection.logout()
+    self.__server.Stop()
+
+  def testMap(self):
+    self.__pool.SelectMailbox("INBOX")
+
+    # Calls wait until every connection is in use, so that the items can't
+    # all be processed by the first connection. If that doesn't happen, the
+    # first call to give up stops the others from waiting.
+    used_connections = set()
+    all_used = threading.Event()
+    def Double(connection, item):
+      used_connections.add(connection)
+      if len(used_connections) == self._CONNECTION_COUNT:
+        all_used.set()
+      if not all_used.wait(5):
+        all_used.set()
+
+      r, data = connection.noop()
+      self.assertEqual("OK", r)
+      return item * 2
+
+    items = range(100)
+    self.assertEqual(
+        [item * 2 for item in items], self.__pool.Map(Double, items))
+    self.assertEqual(self._CONNECTION_COUNT, len(used_connections))
+
+    self.__pool.Logout()
+
+  def testMapError(self):
+    def Fail(connection, item):
+      if item == 5:
+        raise ValueError("item %d" % item)
+      return item
+
+    self.assertRaises(ValueError, self.__pool.Map, Fail, range(10))
+
+  def testSelectMissingMailbox(self):
+    self.assertRaises(
+        imaplib.IMAP4.error, self.__pool.SelectMailbox, "Missing")
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,128 @@
+# In-process IMAP server for tests. Supports just enough of the protocol for
+# imaplib to log in and select mailboxes, and for Mail to search and fetch
+# message headers.
+
+import SocketServer
+import threading
+
+class FakeMessage(object):
+  def __init__(self, uid, date_string, size, headers):
+    self.uid = uid
+    self.date_string = date_string
+    self.size = size
+    self.headers = headers
+
+class _FakeImapHandler(SocketServer.StreamRequestHandler):
+  def handle(self):
+    self.__mailbox = None
+
+    self.__Send("* OK fake server ready")
+    while True:
+      line = self.rfile.readline()
+      if not line:
+        return
+      tag, command = line.rstrip("\r\n").split(" ", 1)
+      name, args = (command + " ").split(" ", 1)
+      name = name.upper()
+      args = args.strip()
+
+      if name == "CAPABILITY":
+        self.__Send("* CAPABILITY IMAP4rev1")
+        self.__Send("%s OK CAPABILITY completed" % tag)
+      elif name == "SELECT":
+        self.__Select(tag, args)
+      elif name == "UID":
+        self.__Uid(tag, args)
+      elif name == "LOGOUT":
+        self.__Send("* BYE")
+        self.__Send("%s OK LOGOUT completed" % tag)
+        return
+      elif name in ["LOGIN", "NOOP", "CLOSE"]:
+        self.__Send("%s OK %s completed" % (tag, name))
+      else:
+        self.__Send("%s BAD unknown command" % tag)
+
+  def __Select(self, tag, mailbox):
+    mailbox = mailbox.strip('"')
+    if mailbox not in self.server.mailboxes:
+      self.__mailbox = None
+      self.__Send("%s NO no such mailbox" % tag)
+      return
+
+    self.__mailbox = self.server.mailboxes[mailbox]
+    self.__Send("* %d EXISTS" % len(self.__mailbox))
+    self.__Send("* OK [UIDVALIDITY %d] UIDs valid" % self.server.uid_validity)
+    self.__Send("%s OK [READ-WRITE] SELECT completed" % tag)
+
+  def __Uid(self, tag, args):
+    command, args = args.split(" ", 1)
+    command = command.upper()
+
+    if self.__mailbox is None:
+      self.__Send("%s BAD no mailbox selected" % tag)
+    elif command == "SEARCH" and args.upper() == "ALL":
+      self.__Send("* SEARCH %s" %
+          " ".join([str(message.uid) for message in self.__mailbox]))
+      self.__Send("%s OK SEARCH completed" % tag)
+    elif command == "FETCH":
+      self.__Fetch(tag, args.split(" ", 1)[0])
+    else:
+      self.__Send("%s BAD unknown UID command" % tag)
+
+  def __Fetch(self, tag, message_set):
+    # Only lists of UIDs are supported (not ranges)
+    try:
+      uids = set([int(uid) for uid in message_set.split(",")])
+    except ValueError:
+      self.__Send("%s BAD invalid message set" % tag)
+      return
+
+    self.server.fetch_handlers.add(id(self))
+
+    # Servers can send other untagged responses in the middle of a reply
+    self.__Send("* %d EXISTS" % len(self.__mailbox))
+
+    # All the supported fields are sent, whichever ones were asked for
+    for i, message in enumerate(self.__mailbox):
+      if message.uid not in uids:
+        continue
+      self.__Send(
+          "* %d FETCH (UID %d FLAGS (\\Seen) INTERNALDATE \"%s\" "
+          "RFC822.SIZE %d RFC822.HEADER {%d}" % (
+              i + 1, message.uid, message.date_string, message.size,
+              len(message.headers)))
+      self.wfile.write(message.headers)
+      self.__Send(")")
+    self.__Send("%s OK FETCH completed" % tag)
+
+  def __Send(self, line):
+    self.wfile.write(line + "\r\n")
+    self.wfile.flush()
+
+class FakeImapServer(SocketServer.ThreadingTCPServer):
+  '''Serves the given mailboxes (a map from names to lists of FakeMessages, in
+  UID order) on a free localhost port, from a background thread.'''
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, mailboxes, uid_validity=1):
+    SocketServer.ThreadingTCPServer.__init__(
+        self, ("localhost", 0), _FakeImapHandler)
+    self.mailboxes = mailboxes
+    self.uid_validity = uid_validity
+    # IDs of the connection handlers that have fetched messages
+    self.fetch_handlers = set()
+
+  def Start(self):
+    # Polls often, so that Stop doesn't have to wait long
+    thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+    thread.setDaemon(True)
+    thread.start()
+
+  def Stop(self):
+    self.shutdown()
+    self.server_close()
+
+  def GetAddress(self):
+    '''Address in the host:port form that Mail takes.'''
+    return "%s:%d" % self.server_address
@@ -0,0 +1,76 @@
+# Reads the reply to an IMAP FETCH command one message at a time, as it comes
+# off the socket, instead of having imaplib buffer the whole reply first. This
+# keeps memory use down to one message's worth of data, and lets the caller
+# parse messages while the rest of the reply is still being transferred.
+
+import imaplib
+import itertools
+import re
+
+_LITERAL_RE = re.compile(r"\{(\d+)\}$")
+_FETCH_RESPONSE_RE = re.compile(r"\* (\d+) FETCH (.*)$", re.DOTALL)
+
+# Tags only need to be distinct from the ones imaplib uses
+_TAG_PREFIX = "MTF"
+_tag_counter = itertools.count()
+
+class FetchReader(object):
+  def __init__(self, connection):
+    self.__connection = connection
+
+  def UidFetch(self, message_set, fetch_parts):
+    '''Generator that yields the data for each message in the reply, in the
+    same format that imaplib uses for a FETCH reply (a list of strings and
+    (string, literal) tuples).'''
+    tag = "%s%d" % (_TAG_PREFIX, _tag_counter.next())
+
+    self.__connection.send(
+        "%s UID FETCH %s %s\r\n" % (tag, message_set, fetch_parts))
+
+    while True:
+      line = self.__ReadLine()
+
+      if line.startswith(tag + " "):
+        status = line[len(tag) + 1:].split(" ", 1)[0]
+        if status != "OK":
+          raise imaplib.IMAP4.error("FETCH command error: %s" % line)
+        return
+
+      # Literals are followed by the rest of the response on a new line
+      response = []
+      while True:
+        match = _LITERAL_RE.search(line)
+        if not match:
+          response.append(line)
+          break
+
+        literal = self.__connection.read(int(match.group(1)))
+        response.append((line, literal))
+        line = self.__ReadLine()
+
+      first_line = response[0]
+      if type(first_line) == tuple: first_line = first_line[0]
+
+      match = _FETCH_RESPONSE_RE.match(first_line)
+
+      # Ignore other untagged responses (e.g. EXISTS updates)
+      if not match: continue
+
+      # Like imaplib, only keep the sequence number and the data
+      first_line = "%s %s" % match.groups()
+      if type(response[0]) == tuple:
+        response[0] = (first_line, response[0][1])
+      else:
+        response[0] = first_line
+
+      yield response
+
+  def __ReadLine(self):
+    line = self.__connection.readline()
+    if not line:
+      raise imaplib.IMAP4.abort("socket error: EOF")
+
+    if line.endswith("\r\n"):
+      line = line[:-2]
+
+    return line
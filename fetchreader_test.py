@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+import imaplib
+import unittest
+
+import fakeimapserver
+import fetchreader
+
+class FetchReaderTest(unittest.TestCase):
+  _HEADERS = "Subject: Hello\r\nMessage-ID: <%d@example.com>\r\n\r\n"
+
+  def setUp(self):
+    messages = [
+      fakeimapserver.FakeMessage(
+          uid, "01-Mar-2008 10:00:00 +0000", 100, self._HEADERS % uid)
+      for uid in [3, 5, 8]
+    ]
+    self.__server = fakeimapserver.FakeImapServer({"INBOX": messages})
+    self.__server.Start()
+
+    host, port = self.__server.server_address
+    self.__connection = imaplib.IMAP4(host, port)
+    self.__connection.login("user", "password")
+    self.__connection.select("INBOX")
+
+  def tearDown(self):
+    self.__connection.logout()
+    self.__server.Stop()
+
+  def testUidFetch(self):
+    reader = fetchreader.FetchReader(self.__connection)
+    replies = list(reader.UidFetch("3,8", "(UID RFC822.HEADER)"))
+
+    # The EXISTS response in the middle of the reply is skipped, and the rest
+    # are in the same format as imaplib's
+    self.assertEqual(2, len(replies))
+    for reply, (sequence_number, uid) in zip(replies, [(1, 3), (3, 8)]):
+      self.assertEqual(2, len(reply))
+      line, literal = reply[0]
+      self.assertTrue(line.startswith("%d (UID %d " % (sequence_number, uid)))
+      self.assertTrue(line.endswith("RFC822.HEADER {%d}" % len(literal)))
+      self.assertEqual(self._HEADERS % uid, literal)
+      self.assertEqual(")", reply[1])
+
+    # The connection can still be used for other commands afterwards
+    r, data = self.__connection.noop()
+    self.assertEqual("OK", r)
+
+  def testUidFetchError(self):
+    reader = fetchreader.FetchReader(self.__connection)
+    self.assertRaises(
+        imaplib.IMAP4.error, list, reader.UidFetch("bad", "(UID)"))
+
+if __name__ == "__main__":
+  unittest.main()
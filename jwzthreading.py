@@ -14,12 +14,13 @@ import re
 
 __all__ = ['Message', 'make_message', 'thread']
 
-class Container:
-    __slots__ = ['message', 'parent', 'children', 'id']
+class Container (object):
+    __slots__ = ['message', 'parent', 'children', 'subject', 'message_id']
     def __init__ (self):
         self.message = self.parent = None
         self.children = []
         self.subject = None
+        self.message_id = None
 
     def __repr__ (self):
         return '<%s %x: %r>' % (self.__class__.__name__, id(self),
@@ -29,7 +30,7 @@ class Container:
         return self.message is None
 
     def add_child (self, child):
-        if child.parent:
+        if child.parent is not None:
             child.parent.remove_child(child)
         self.children.append(child)
         child.parent = self
@@ -39,24 +40,41 @@ class Container:
         child.parent = None
 
     def has_descendant (self, ctr):
-        if self is ctr:
-            return True
-        for c in self.children:
-            if c is ctr:
-                return True
-            elif c.has_descendant(ctr):
+        # Walk up from ctr (whose depth is usually much smaller than the
+        # size of this container's subtree)
+        while ctr is not None:
+            if ctr is self:
                 return True
+            ctr = ctr.parent
         return False
 
+    def walk (self):
+        """walk() : iterator over (Container, int)
+        Yields this container and all of its descendants (depth-first,
+        in order), along with their depth below this container. Doesn't
+        recurse, so that deep threads can't hit the recursion limit.
+        """
+        stack = [(self, 0)]
+        while stack:
+            container, depth = stack.pop()
+            yield container, depth
+            for c in reversed(container.children):
+                stack.append((c, depth + 1))
+
     def __len__(self):
-      count = 1
-      for c in self.children:
-        count += len(c)
+      count = 0
+      for c, depth in self.walk():
+        count += 1
       return count
     
 def uniq(alist):
-    set = {}
-    return [set.setdefault(e,e) for e in alist if e not in set.keys()]
+    seen = set()
+    result = []
+    for e in alist:
+        if e not in seen:
+            seen.add(e)
+            result.append(e)
+    return result
 
 msgid_pat = re.compile('<([^>]+)>')
 restrip_pat = re.compile("""(
@@ -109,36 +127,50 @@ class Message (object):
 
 def prune_container (container):
     """prune_container(container:Container) : [Container]
-    Recursively prune a tree of containers, as described in step 4
-    of the algorithm.  Returns a list of the children that should replace
-    this container.
+    Prune a tree of containers, as described in step 4 of the
+    algorithm.  Returns a list of the children that should replace
+    this container.  Containers are visited children first, using an
+    explicit stack instead of recursion.
     """
 
-    # Prune children, assembling a new list of children
-    new_children = []
-    for ctr in container.children[:]:
-        L = prune_container(ctr)
-        new_children.extend(L)
-        container.remove_child(ctr)
-
-    for c in new_children:
-        container.add_child(c)
-
-    if (container.message is None and
-        len(container.children) == 0):
-        # 4.A: nuke empty containers
-        return []
-    elif (container.message is None and
-          (len(container.children)==1 or
-           container.parent is not None)):
-        # 4.B: promote children
-        L = container.children[:]
-        for c in L:
-            container.remove_child(c)
-        return L
-    else:
-        # Leave this node in place
-        return [container]
+    # id(container) to the list of containers that replace it
+    replacements = {}
+
+    stack = [(container, False)]
+    while stack:
+        ctr, children_pruned = stack.pop()
+        if not children_pruned:
+            stack.append((ctr, True))
+            for c in ctr.children:
+                stack.append((c, False))
+            continue
+
+        # Replace the children with their pruned versions
+        new_children = []
+        for c in ctr.children:
+            new_children.extend(replacements.pop(id(c)))
+        ctr.children = new_children
+        for c in new_children:
+            c.parent = ctr
+
+        if (ctr.message is None and
+            len(ctr.children) == 0):
+            # 4.A: nuke empty containers
+            L = []
+        elif (ctr.message is None and
+              (len(ctr.children)==1 or
+               ctr.parent is not None)):
+            # 4.B: promote children
+            L = ctr.children
+            ctr.children = []
+            for c in L:
+                c.parent = None
+        else:
+            # Leave this node in place
+            L = [ctr]
+        replacements[id(ctr)] = L
+
+    return replacements[id(container)]
 
         
 def thread (msglist):
@@ -175,13 +207,19 @@ def thread (msglist):
                 # Don't add link if it would create a loop
                 if container is this_container:
                     continue
-                if container.has_descendant(prev):
-                    continue
-                prev.add_child(container)
+                # Already linked (re-adding would just move it to the
+                # end of the children list). Checked first, since it's
+                # cheaper than walking up from prev.
+                if container.parent is not prev:
+                    if container.has_descendant(prev):
+                        continue
+                    prev.add_child(container)
 
             prev = container
 
-        if prev is not None:
+        if (prev is not None and
+            this_container.parent is not prev and
+            not this_container.has_descendant(prev)):
             prev.add_child(this_container)
 
     # 2. Find root set
@@ -3,36 +3,66 @@ import logging
 import random
 
 import cache
+import connectionpool
+import fetchreader
 import messageinfo
 import stringscanner
 
 MAILBOX_GMAIL_ALL_MAIL = "[Gmail]/All Mail"
 MAILBOX_GMAIL_PREFIX = "[Gmail]"
 
+CAPABILITY_GMAIL_EXTENSIONS = "X-GM-EXT-1"
+
 class Mail(object):
   def __init__(self, server, use_ssl, username, password, 
-      record=False, replay=False, max_messages=-1, random_subset=False):
+      record=False, replay=False, max_messages=-1, random_subset=False,
+      store=None, connection_count=1):
     self.__server = server
     self.__username = username
     self.__record = record
     self.__replay = replay
     self.__max_messages = max_messages
     self.__random_subset = random_subset
+    self.__store = store
     
     self.__current_mailbox = None
+    self.__current_uid_validity = None
     
     if record or replay:
       self.__cache = cache.FileCache()
     
+    self.__mail = self.__Connect(server, use_ssl, username, password)
+    
+    # The main connection is also part of the pool, so that there are at most
+    # connection_count connections open
+    connections = [self.__mail]
+    for i in xrange(1, connection_count):
+      connections.append(self.__Connect(server, use_ssl, username, password))
+    self.__pool = connectionpool.ConnectionPool(connections)
+
+  def __Connect(self, server, use_ssl, username, password):
     imap_constructor = use_ssl and imaplib.IMAP4_SSL or imaplib.IMAP4
     
     logging.info("Connecting")
     
-    self.__mail = imap_constructor(server)
+    # Allow a non-standard port to be given as part of the server name
+    if server.find(":") != -1:
+      host, port = server.rsplit(":", 1)
+      connection = imap_constructor(host, int(port))
+    else:
+      connection = imap_constructor(server)
 
     logging.info("Logging in")
     
-    self.__mail.login(username, password)
+    connection.login(username, password)
+    
+    return connection
+
+  def GetUidValidity(self):
+    return self.__current_uid_validity
+
+  def HasGmailExtensions(self):
+    return CAPABILITY_GMAIL_EXTENSIONS in self.__mail.capabilities
 
   def GetMailboxes(self):
     logging.info("Getting mailboxes")
@@ -61,38 +91,143 @@ class Mail(object):
 
   def SelectMailbox(self, mailbox):
     logging.info("Selecting mailbox '%s'", mailbox)
-    r, data = self.__mail.select(mailbox)
-    self.__AssertOk(r)
+    self.__pool.SelectMailbox(mailbox)
+    
+    r, data = self.__mail.response("UIDVALIDITY")
     
     self.__current_mailbox = mailbox
+    self.__current_uid_validity = data[0]
 
   def GetMessageIds(self):
-    message_infos = self.__UidFetch("ALL", "(INTERNALDATE RFC822.SIZE)")
-    
-    return [m.GetMessageId() for m in message_infos]
+    return self.__StoredUidFetch(
+        "ALL", 
+        "(INTERNALDATE RFC822.SIZE)",
+        lambda message_info: message_info.GetMessageId())
 
-  def GetMessageInfos(self):
-    return self.__UidFetch(
+  def GetMessageInfos(self, header_fields=None, fetch_labels=False):
+    # Fetching just the header fields that will be used (if they're known) 
+    # is a lot less data to transfer and parse
+    if header_fields:
+      headers_part = "BODY.PEEK[HEADER.FIELDS (%s)]" % " ".join(header_fields)
+    else:
+      headers_part = "RFC822.HEADER"
+    
+    # With the Gmail extensions, labels can be fetched along with everything
+    # else, instead of having to look in each mailbox
+    fetch_labels = fetch_labels and self.HasGmailExtensions()
+    if fetch_labels:
+      labels_part = " X-GM-MSGID X-GM-THRID X-GM-LABELS"
+    else:
+      labels_part = ""
+    
+    message_infos = self.__StoredUidFetch(
         "ALL", 
-        "(UID FLAGS INTERNALDATE RFC822.SIZE RFC822.HEADER)",
+        "(UID FLAGS INTERNALDATE RFC822.SIZE %s%s)" % (
+            headers_part, labels_part),
+        lambda message_info: message_info,
         self.__max_messages)
+    
+    # Labels of stored messages may have changed since they were fetched
+    if fetch_labels and self.__store:
+      self.__RefreshLabels(message_infos)
+    
+    if self.__store:
+      self.__UpdateNameResolver(message_infos)
+    
+    return message_infos
+
+  def __UpdateNameResolver(self, message_infos):
+    # Names are counted once per message, so the stored resolver only needs 
+    # to see messages past the ones that it has already counted
+    key = "%s-%s-%s-names-%d" % (
+        self.__server, self.__username, self.__current_mailbox,
+        messageinfo.MESSAGE_INFO_VERSION)
+    resolver = self.__store.GetNameResolver(
+        key, self.__current_uid_validity)
+    messageinfo.MessageInfo.name_resolver = resolver
+    
+    last_uid = resolver.last_uid
+    for message_info in message_infos:
+      if message_info.GetUid() > resolver.last_uid:
+        message_info.GetSender()
+        message_info.GetRecipients()
+        last_uid = max(last_uid, message_info.GetUid())
+    resolver.last_uid = last_uid
+    
+    self.__store.SetNameResolver(key, resolver)
+
+  def __RefreshLabels(self, message_infos):
+    logging.info("Refreshing labels")
+    
+    message_infos_by_uid = dict([(m.GetUid(), m) for m in message_infos])
+    
+    label_infos = self.__FetchMessageInfos(
+        [str(uid) for uid in sorted(message_infos_by_uid.keys())],
+        "(UID X-GM-LABELS)")
+    for label_info in label_infos:
+      message_info = message_infos_by_uid[label_info.GetUid()]
+      message_info.SetMailboxes(label_info.GetMailboxes())
 
   def Logout(self):
     logging.info("Logging out")
       
-    self.__mail.close()
-    self.__mail.logout()  
+    self.__pool.Logout()
+
+  def __StoredUidFetch(
+      self, search_criterion, fetch_parts, get_value, max_fetch=-1):
+    if not self.__store:
+      return [get_value(m) for m in 
+          self.__UidFetch(search_criterion, fetch_parts, max_fetch)]
+    
+    logging.info("Fetching message infos")
+    
+    all_message_ids = self.__UidSearch(search_criterion)
+    message_ids = self.__SelectMessageIds(all_message_ids, max_fetch)
+    
+    # The fetched parts are part of the key since they determine what the 
+    # stored values contain
+    store_key = "%s-%s-%s-%d-%s" % (
+        self.__server, self.__username, self.__current_mailbox, 
+        messageinfo.MESSAGE_INFO_VERSION, fetch_parts)
+    state = self.__store.GetMailboxState(
+        store_key, self.__current_uid_validity)
+    state.Prune([int(uid) for uid in all_message_ids])
+    
+    # Normally these are just the UIDs past the high-water mark, but fetching
+    # a subset (via max_fetch) can leave gaps below it.
+    new_message_ids = [uid for uid in message_ids
+        if int(uid) > state.last_uid or int(uid) not in state.values]
+    
+    logging.info("  %d messages are new" % len(new_message_ids))
+    
+    for message_info in self.__FetchMessageInfos(
+        new_message_ids, fetch_parts):
+      state.Add(message_info.GetUid(), get_value(message_info))
+    
+    self.__store.SetMailboxState(store_key, state)
+    
+    return [state.values[int(uid)] for uid in message_ids
+        if int(uid) in state.values]
 
   def __UidFetch(self, search_criterion, fetch_parts, max_fetch=-1):
     logging.info("Fetching message infos")
     
+    message_ids = self.__SelectMessageIds(
+        self.__UidSearch(search_criterion), max_fetch)
+    
+    return self.__FetchMessageInfos(message_ids, fetch_parts)
+  
+  def __UidSearch(self, search_criterion):
     logging.info("  Fetching message list")
     data = self.__UidCommand("SEARCH", search_criterion)
     
     message_ids = data[0].split()
 
     logging.info("  %d messages were listed" % len(message_ids))
-
+    
+    return message_ids
+  
+  def __SelectMessageIds(self, message_ids, max_fetch):
     if max_fetch != -1 and len(message_ids) > max_fetch:
       if self.__random_subset:
         # Pick random sample when there is a max, so that we get more 
@@ -109,40 +244,66 @@ class Mail(object):
       else:
         message_ids = message_ids[-max_fetch - 1:-1]
     
-    message_infos = []
-    
+    return message_ids
+  
+  def __FetchMessageInfos(self, message_ids, fetch_parts):
     # Fetch in smaller chunks, so that record/replay can be used when fetches
-    # fail (to allow caching of successful chunks) and to have better progress
-    # display
+    # fail (to allow caching of successful chunks), to have better progress
+    # display and so that chunks can be fetched in parallel
     chunk_size = fetch_parts.find("HEADER") != -1 and 1000 or 100000
     
+    chunks = []
     for i in xrange(0, len(message_ids), chunk_size):
       chunk_start = i
       chunk_end = i + chunk_size
       if chunk_end > len(message_ids):
         chunk_end = len(message_ids)
       
-      chunk_message_ids = message_ids[chunk_start:chunk_end]
-    
+      chunks.append((message_ids[chunk_start:chunk_end], chunk_end))
+
+    def FetchChunk(connection, chunk):
+      chunk_message_ids, chunk_end = chunk
+      
       logging.info("  Fetching info for %d messages (%d/%d)", 
           len(chunk_message_ids),
           chunk_end,
           len(message_ids))
+      
+      # Record/replay work with whole replies, otherwise messages are parsed
+      # as they arrive
+      if self.__record or self.__replay:
+        fetch_reply = self.__UidCommand(
+            "FETCH",
+            ",".join(chunk_message_ids), 
+            fetch_parts,
+            connection=connection)
+      
+        logging.info("  Parsing replies")
+      
+        return self.__ParseFetchReply(fetch_reply)
+      
+      chunk_message_infos = []
+      
+      reader = fetchreader.FetchReader(connection)
+      for message_reply in reader.UidFetch(
+          ",".join(chunk_message_ids), fetch_parts):
+        chunk_message_infos.extend(self.__ParseFetchReply(message_reply))
+      
+      return chunk_message_infos
     
-      fetch_reply = self.__UidCommand(
-          "FETCH",
-          ",".join(chunk_message_ids), 
-          fetch_parts)
-    
-      logging.info("  Parsing replies")
-    
-      message_infos.extend(self.__ParseFetchReply(fetch_reply))
+    # Chunk results come back in the same order as the chunks, so message
+    # infos stay in UID order
+    message_infos = []
+    for chunk_message_infos in self.__pool.Map(FetchChunk, chunks):
+      message_infos.extend(chunk_message_infos)
     
     logging.info("  Got %d message infos" % len(message_infos))
     
     return message_infos
 
-  def __UidCommand(self, command, *args):
+  def __UidCommand(self, command, *args, **kwargs):
+    connection = kwargs.get("connection", self.__mail)
+    
     if self.__record or self.__replay:
       cache_key = "%s-%s-%s-%s-%s" % (
           self.__server, self.__username, self.__current_mailbox, 
@@ -153,7 +314,7 @@ class Mail(object):
       if cached_response:
         return cached_response
     
-    r, data = self.__mail.uid(command, *args)
+    r, data = connection.uid(command, *args)
     self.__AssertOk(r)
     
     if self.__record:
@@ -179,6 +340,13 @@ class Mail(object):
       while s.Peek() != ")":
         s.ConsumeAll(" ")
         name = s.ReadUntil(" ")
+        
+        # Section specifiers (e.g. BODY[HEADER.FIELDS (FROM TO)]) may contain
+        # spaces
+        if name.find("[") != -1 and name.find("]") == -1:
+          name += s.ReadUntil("]")
+          name += s.ReadChar()
+        
         s.ConsumeAll(" ")
         
         value = s.ConsumeValue()
@@ -190,4 +358,5 @@ class Mail(object):
     return message_infos
   
   def __AssertOk(self, response):
-    assert response == "OK"
+    if response != "OK":
+      raise imaplib.IMAP4.error("IMAP command error: %s" % response)
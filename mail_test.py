@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import unittest
+
+import fakeimapserver
+import mail
+
+def _MakeMessages(count):
+  messages = []
+  for i in xrange(count):
+    headers = (
+        "From: Sender %d <sender%d@example.com>\r\n"
+        "Subject: Message %d\r\n"
+        "Message-ID: <message%d@example.com>\r\n"
+        "\r\n" % (i % 7, i % 7, i, i))
+    # UIDs have gaps, like in a real mailbox
+    messages.append(fakeimapserver.FakeMessage(
+        i * 3 + 1,
+        "%2d-Mar-2008 %02d:%02d:00 -0800" % (i % 28 + 1, i % 24, i % 60),
+        1000 + i,
+        headers))
+  return messages
+
+def _GetMessageInfoFields(message_info):
+  return (
+      message_info.GetUid(),
+      message_info.GetDateSec(),
+      message_info.size,
+      message_info.GetHeader("subject"),
+      message_info.GetSender())
+
+class MailTest(unittest.TestCase):
+  # More than one chunk's worth (chunks are 1000 messages when fetching
+  # headers), so that chunks are fetched over different connections
+  _MESSAGE_COUNT = 4500
+
+  def setUp(self):
+    self.__messages = _MakeMessages(self._MESSAGE_COUNT)
+    self.__server = fakeimapserver.FakeImapServer(
+        {mail.MAILBOX_GMAIL_ALL_MAIL: self.__messages})
+    self.__server.Start()
+
+  def tearDown(self):
+    self.__server.Stop()
+
+  def __GetMessageInfos(self, connection_count):
+    m = mail.Mail(
+        self.__server.GetAddress(), False, "user", "password",
+        connection_count=connection_count)
+    m.SelectAllMail()
+    message_infos = m.GetMessageInfos()
+    m.Logout()
+    return message_infos
+
+  def testGetMessageInfosWithConnectionPool(self):
+    single_message_infos = self.__GetMessageInfos(1)
+    self.assertEqual(len(self.__messages), len(single_message_infos))
+    for message, message_info in zip(self.__messages, single_message_infos):
+      self.assertEqual(message.uid, message_info.GetUid())
+
+    self.__server.fetch_handlers.clear()
+    pool_message_infos = self.__GetMessageInfos(3)
+    self.assertTrue(len(self.__server.fetch_handlers) > 1)
+
+    # Compared one at a time, since a diff of the whole lists would be slow
+    self.assertEqual(len(single_message_infos), len(pool_message_infos))
+    for single_message_info, pool_message_info in zip(
+        single_message_infos, pool_message_infos):
+      self.assertEqual(
+          _GetMessageInfoFields(single_message_info),
+          _GetMessageInfoFields(pool_message_info))
+
+if __name__ == "__main__":
+  unittest.main()
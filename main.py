@@ -5,27 +5,33 @@ import logging
 import messageinfo
 import re
 import sys
+import time
 
-from Cheetah.Template import Template
-import jwzthreading
+from templates import WriteTemplate
 
 import mail
+import messagestore
+import messagethreads
+import messagetable
 import stats.base
 import stats.bucket
+import stats.distribution
 import stats.group
 import stats.table
 
 def GetOptsMap():
   opts, args = getopt.getopt(sys.argv[1:], "", [
       # Standard options
-      "username=", "password=", "use_ssl", "server=", 
+      "username=", "password=", "use_ssl", "server=", "connections=",
+      "processes=",
 
       # Other params
-      "filter_out=", "me=",
+      "filter_out=", "me=", "store=", "address_counters=",
+      "distribution_bucket_days=", "distribution_window=",
       
       # Development options
       "record", "replay", 
-      "max_messages=", "random_subset",
+      "max_messages=", "random_subset", "minimal_headers",
       "skip_labels"])
   
   opts_map = {}
@@ -40,31 +46,47 @@ def GetOptsMap():
   
   assert "password" in opts_map
   assert "server" in opts_map
+
+  # The distribution options are divisors when bucketing and smoothing, and
+  # address counting needs at least one counter
+  for name in [
+      "distribution_bucket_days", "distribution_window", "address_counters"]:
+    if name in opts_map and int(opts_map[name]) < 1:
+      raise getopt.GetoptError("--%s must be at least 1" % name, name)
   
   return opts_map
 
 def GetMessageInfos(opts):
+  store = None
+  if "store" in opts:
+    store = messagestore.MessageStore(opts["store"])
+
   m = mail.Mail(
       opts["server"], "use_ssl" in opts, opts["username"], opts["password"],
       "record" in opts, "replay" in opts, 
       "max_messages" in opts and int(opts["max_messages"]) or -1,
-      "random_subset" in opts)
+      "random_subset" in opts,
+      store,
+      "connections" in opts and int(opts["connections"]) or 1)
   
   # First, get all message infos
   m.SelectAllMail()
   
-  message_infos = m.GetMessageInfos()
+  if "minimal_headers" in opts:
+    header_fields = GetHeaderFields(opts)
+  else:
+    header_fields = None
+  
+  message_infos = m.GetMessageInfos(
+      header_fields, fetch_labels="skip_labels" not in opts)
+  uid_validity = m.GetUidValidity()
   
   # Then for each mailbox, see which messages are in it, and attach that to 
-  # the mail info
-  if "skip_labels" not in opts:
+  # the mail info (unnecessary if labels were fetched along with the messages)
+  if "skip_labels" not in opts and not m.HasGmailExtensions():
     message_infos_by_id = \
         dict([(mi.GetMessageId(), mi) for mi in message_infos])
     
-    # Don't want to parse all these dates, since we already have them from the
-    # message infos above.
-    messageinfo.MessageInfo.SetParseDate(False)
-    
     for mailbox in m.GetMailboxes():
       m.SelectMailbox(mailbox)
       message_ids = m.GetMessageIds()
@@ -72,73 +94,102 @@ def GetMessageInfos(opts):
         if mid in message_infos_by_id:
           message_info = message_infos_by_id[mid]
           message_info.AddMailbox(mailbox)
-  
-    messageinfo.MessageInfo.SetParseDate(True)
 
   m.Logout()
   
-  # Filter out those that we're not interested in
-  if "filter_out" in opts:
-    message_infos = FilterMessageInfos(message_infos, opts["filter_out"])
+  return message_infos, uid_validity
+
+def TagMeMessages(messages, me_param):
+  logging.info("Identifying \"me\" messages")
+  me_addresses = [address.lower().strip() for address in me_param.split(",")]
   
-  # Tag messages as being from the user running the script
-  if "me" in opts:
-    logging.info("Identifying \"me\" messages")
-    me_addresses = [
-        address.lower().strip() for address in opts["me"].split(",")]
-    
-    me_from_count = 0
-    me_to_count = 0
+  # Addresses that aren't in the table aren't in any message either
+  me_indices = set()
+  for me_address in me_addresses:
+    index = messages.addresses.FindIndex(me_address)
+    if index is not None:
+      me_indices.add(index)
+  
+  me_from_count = 0
+  me_to_count = 0
+  
+  for i in xrange(len(messages)):
+    if messages.senders[i] in me_indices:
+      messages.from_me.Set(i)
+      me_from_count += 1
     
-    for message_info in message_infos:
-      name, address = message_info.GetSender()
-      
-      for me_address in me_addresses:
-        if me_address == address:
-          message_info.is_from_me = True
-          me_from_count += 1
-          break
-          
-      for name, address in message_info.GetRecipients():
-        for me_address in me_addresses:
-          if me_address == address:
-            message_info.is_to_me = True
-            me_to_count += 1
-            break
-        if message_info.is_to_me: break
-            
-    logging.info("  %d messages are from \"me\"" % me_from_count)
-    logging.info("  %d messages are to \"me\"" % me_to_count)
-  
-  return message_infos
-
-def FilterMessageInfos(message_infos, filter_param):
+    for address_index in messages.GetRecipientIndices(i):
+      if address_index in me_indices:
+        messages.to_me.Set(i)
+        me_to_count += 1
+        break
+  
+  logging.info("  %d messages are from \"me\"" % me_from_count)
+  logging.info("  %d messages are to \"me\"" % me_to_count)
+
+def GetHeaderFields(opts):
+  # Headers used by jwzthreading.make_message
+  header_fields = ["Message-ID", "References", "In-Reply-To", "Subject"]
+  
+  if "filter_out" in opts or "me" in opts:
+    header_fields.extend(messageinfo.SENDER_HEADER_FIELDS)
+    header_fields.extend(messageinfo.RECIPIENT_HEADER_FIELDS)
+  if "filter_out" in opts:
+    header_fields.extend(messageinfo.LIST_ID_HEADER_FIELDS)
+  
+  # The real date range isn't known until messages are fetched, but it doesn't
+  # affect which stats are created (and thus which fields they use)
+  now = time.time()
+  for stat in InitStats([now, now]):
+    header_fields.extend(stat.GetHeaderFields())
+  
+  # Remove duplicates but preserve order
+  unique_header_fields = []
+  for header_field in header_fields:
+    if header_field not in unique_header_fields:
+      unique_header_fields.append(header_field)
+  
+  return unique_header_fields
+
+def FilterMessages(messages, filter_param):
   logging.info("Filtering messages")
-  remaining_message_infos = []
   
   filters = []
   raw_filters = filter_param.split(",")
   for raw_filter in raw_filters:
     operator, value = raw_filter.strip().split(":", 1)
+    if operator not in ["to", "from", "list"]:
+      raise AssertionError("unknown operator: %s" % operator)
     filters.append([operator, value.lower()])
   
-  for message_info in message_infos:
+  # Each address only needs to be matched against the filters once
+  address_matches = {}
+  def MatchesFilter(address_index, operator, operator_value):
+    key = (address_index, operator, operator_value)
+    if key not in address_matches:
+      name, address = messages.addresses.GetPair(address_index)
+      # List IDs are only identified by their address
+      if operator == "list":
+        name = address
+      address_matches[key] = \
+          (name and name.lower() or "").find(operator_value) != -1 or \
+          (address and address.lower() or "").find(operator_value) != -1
+    return address_matches[key]
+  
+  remaining_indices = []
+  
+  for i in xrange(len(messages)):
     filtered_out = False
     for operator, operator_value in filters:
       if operator == "to":
-        pairs = message_info.GetRecipients()
+        address_indices = messages.GetRecipientIndices(i)
       elif operator == "from":
-        pairs = [message_info.GetSender()]
+        address_indices = [messages.senders[i]]
       elif operator == "list":
-        pairs = [message_info.GetListId()]
-      else:
-        raise AssertionError("unknown operator: %s" % operator)
-
-      values = [name and name.lower() or "" for name, address in pairs] + \
-               [address and address.lower() or "" for name, address in pairs]
+        address_indices = [messages.list_ids[i]]
 
-      for value in values:
-        if value.find(operator_value) != -1:
+      for address_index in address_indices:
+        if MatchesFilter(address_index, operator, operator_value):
           filtered_out = True
           break
       
@@ -146,35 +197,122 @@ def FilterMessageInfos(message_infos, filter_param):
         break
     
     if not filtered_out:
-      remaining_message_infos.append(message_info)
-
-  logging.info("  %d messages remaining" % len(remaining_message_infos))
-  return remaining_message_infos
-
-def ExtractThreads(message_infos):
-  thread_messages = []
-  for message_info in message_infos:
-    thread_message = jwzthreading.make_message(message_info.headers)
-    if thread_message:
-      thread_message.message_info = message_info
-      thread_messages.append(thread_message)
-      
-  thread_dict = jwzthreading.thread(thread_messages)
-  
-  containers = []
-  for subject, container in thread_dict.items():
-    # jwzthreading is too aggressive in threading by subject and will combine
-    # distinct threads that happen to have the same subject. Split them up if
-    # we have a dummy container that has lots of children at the first level.
-    if container.is_dummy() and len(container.children) >= 10:
-      for child_container in container.children:
-        child_container.subject = subject
-        containers.append(child_container)
+      remaining_indices.append(i)
+
+  logging.info("  %d messages remaining" % len(remaining_indices))
+  return messages.Select(remaining_indices)
+
+def ProcessStats(top_level_stats, messages, threads, opts, uid_validity):
+  dispatcher = stats.group.StatDispatcher(top_level_stats)
+  process_count = "processes" in opts and int(opts["processes"]) or 1
+  
+  if "store" not in opts:
+    dispatcher.ProcessMessageInfos(messages, threads, process_count)
+    return
+  
+  # Saved aggregates are only valid for the same set of options, and are
+  # updated with the messages that have arrived since they were saved
+  store = messagestore.MessageStore(opts["store"])
+  store_key = "%s-%s-stats-%d-%s" % (
+      opts["server"], 
+      opts["username"], 
+      stats.base.AGGREGATE_VERSION,
+      [opts.get(name) for name in 
+          ["filter_out", "me", "max_messages", "random_subset", 
+              "address_counters", "distribution_bucket_days"]])
+  state = store.GetStatState(store_key, uid_validity)
+  
+  new_indices = [
+    i for i in xrange(len(messages)) if messages.uids[i] > state.last_uid
+  ]
+  
+  # If messages were removed, aggregates can't be updated
+  if state.message_count + len(new_indices) != len(messages):
+    logging.info("  Messages were removed, recomputing all stats")
+    state.aggregates = {}
+  
+  incremental_stats = []
+  recomputed_stats = []
+  for stat in dispatcher.GetStats():
+    key = stat.GetAggregateKey()
+    if stat.IsIncremental() and key in state.aggregates:
+      stat.MergeAggregate(state.aggregates[key])
+      incremental_stats.append(stat)
     else:
-      container.subject = subject
-      containers.append(container)
+      recomputed_stats.append(stat)
+  
+  logging.info("  Updating %d stats with %d new messages, recomputing %d",
+      len(incremental_stats), len(new_indices), len(recomputed_stats))
+  
+  stats.group.StatDispatcher(incremental_stats).ProcessMessages(
+      messages.Select(new_indices), process_count)
+  stats.group.StatDispatcher(recomputed_stats).ProcessMessages(
+      messages, process_count)
+  
+  state.aggregates = {}
+  for stat in dispatcher.GetStats():
+    if stat.IsIncremental():
+      state.aggregates[stat.GetAggregateKey()] = stat.GetAggregate()
+  if messages.uids:
+    state.last_uid = max(state.last_uid, max(messages.uids))
+  state.message_count = len(messages)
+  store.SetStatState(store_key, state)
+  
+  dispatcher.FinishProcessing(messages, threads)
+
+def ExtractThreads(messages, opts, uid_validity):
+  # Gmail has already grouped messages into threads (the ones that it shows),
+  # so jwzthreading is only needed for other servers
+  if messages.HasGmailThreadIds():
+    logging.info("  Grouping by Gmail thread ID")
+    return messagethreads.GetGmailThreads(messages)
+  
+  if "store" not in opts:
+    thread_messages = []
+    for i in xrange(len(messages)):
+      thread_message = messages.thread_messages[i]
+      if thread_message:
+        thread_message.message_info = messages[i]
+        thread_messages.append(thread_message)
     
-  return containers
+    threads = messagethreads.ThreadTable(messages)
+    for container in messagethreads.GetThreads(thread_messages):
+      threads.AddContainer(container)
+    return threads
+  
+  # Saved threads are only valid for the same set of messages, and are 
+  # extended with the messages that have arrived since they were saved
+  store = messagestore.MessageStore(opts["store"])
+  store_key = "%s-%s-threads-%d-%s" % (
+      opts["server"], 
+      opts["username"], 
+      messagethreads.FOREST_VERSION,
+      [opts.get(name) for name in 
+          ["filter_out", "max_messages", "random_subset"]])
+  # Logged (with timestamps) since loading and saving a forest takes about as
+  # long as adding a few hundred messages to it
+  logging.info("  Loading saved threads")
+  state = store.GetThreadState(store_key, uid_validity)
+  
+  new_indices = [
+    i for i in xrange(len(messages)) if messages.uids[i] > state.last_uid
+  ]
+  
+  # If messages were removed, threads can't be updated
+  if state.message_count + len(new_indices) != len(messages):
+    logging.info("  Messages were removed, rethreading all messages")
+    state = messagestore.ThreadState(uid_validity)
+    new_indices = xrange(len(messages))
+  
+  threads = state.forest.Update(messages, new_indices)
+  
+  if messages.uids:
+    state.last_uid = max(state.last_uid, max(messages.uids))
+  state.message_count = len(messages)
+  logging.info("  Saving threads")
+  store.SetThreadState(store_key, state)
+  
+  return threads
 
 def InitStats(date_range):
   s = [
@@ -248,28 +386,54 @@ logging.info("Initializing")
 
 opts = GetOptsMap()
 
-message_infos = GetMessageInfos(opts)
+message_infos, uid_validity = GetMessageInfos(opts)
+
+# Everything that's needed from the message infos is derived once, after which
+# they (and their headers) are no longer needed
+logging.info("Deriving message fields")
+messages = messagetable.MessageTable(message_infos)
+del message_infos
+
+# Filter out those that we're not interested in
+if "filter_out" in opts:
+  messages = FilterMessages(messages, opts["filter_out"])
+
+# Tag messages as being from the user running the script
+if "me" in opts:
+  TagMeMessages(messages, opts["me"])
 
 logging.info("Extracting threads")
-threads = ExtractThreads(message_infos)
+threads = ExtractThreads(messages, opts, uid_validity)
+
+if "address_counters" in opts:
+  stats.table.UniqueAddressTableStat.counter_budget = \
+      int(opts["address_counters"])
 
-stats = InitStats(messageinfo.MessageInfo.GetDateRange())
+if "distribution_bucket_days" in opts:
+  stats.distribution.Distribution.bucket_size = \
+      int(opts["distribution_bucket_days"])
+if "distribution_window" in opts:
+  stats.distribution.Distribution.window_size = \
+      int(opts["distribution_window"])
+
+top_level_stats = InitStats(messages.GetDateRange())
 
 logging.info("Generating stats")
-for stat in stats:
-  stat.ProcessMessageInfos(message_infos, threads)
+ProcessStats(top_level_stats, messages, threads, opts, uid_validity)
 
 logging.info("Outputting HTML")
 
-t = Template(
+# Each stat's HTML is written out as it's generated
+out = codecs.open("out/index.html", mode="w", encoding='utf-8')
+WriteTemplate(
+    out,
     file="templates/index.tmpl",
     searchList = {
-      "stats": stats,
-      "host": re.sub("^.*@", "", opts["username"])
+      "stats": top_level_stats,
+      "host": re.sub("^.*@", "", opts["username"]),
+      "out": out
     }
 )
-out = codecs.open("out/index.html", mode="w", encoding='utf-8')
-out.write(unicode(t))
 out.close()
 
 logging.info("Done")
\ No newline at end of file
@@ -1,3 +1,4 @@
+import calendar
 import email
 import email.utils
 import email.header
@@ -13,20 +14,125 @@ InternalDate = re.compile(r'.*INTERNALDATE "'
         r' (?P<zonen>[-+])(?P<zoneh>[0-9][0-9])(?P<zonem>[0-9][0-9])'
         r'"')
 
-class MessageInfo(object):
-  __oldestMessageSec = time.mktime([2027, 12, 31, 23, 59, 59, 0, 0, 0]) 
-  __newestMessageSec = time.mktime([1970, 1, 1, 0, 0, 0, 0, 0, 0]) 
-  __parseDates = True
+# Part of the key of stored message infos and name resolvers (which are saved
+# as pickled objects), so that ones saved in an older format aren't used.
+# Should be changed when the attributes of either class change.
+MESSAGE_INFO_VERSION = 2
+
+_MONTH_NUMBERS = {
+  "Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+  "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12,
+}
+
+# Parsed dates by their INTERNALDATE string. It's emptied when it gets too big,
+# so that it doesn't end up with an entry for every message.
+_INTERNAL_DATE_CACHE = {}
+_INTERNAL_DATE_CACHE_SIZE = 10000
+
+def ParseInternalDate(date_string):
+  """Parses an INTERNALDATE value (e.g. "17-Jul-1996 02:44:25 -0700") into
+  seconds since the epoch and a local time tuple."""
+  if date_string in _INTERNAL_DATE_CACHE:
+    return _INTERNAL_DATE_CACHE[date_string]
+  
+  if len(_INTERNAL_DATE_CACHE) >= _INTERNAL_DATE_CACHE_SIZE:
+    _INTERNAL_DATE_CACHE.clear()
+  _INTERNAL_DATE_CACHE[date_string] = _ParseInternalDate(date_string)
+  return _INTERNAL_DATE_CACHE[date_string]
+
+def _ParseInternalDate(date_string):
+  # The day is supposed to be padded with a space, but may not be
+  padded_date_string = date_string
+  if len(date_string) == 25:
+    padded_date_string = " " + date_string
   
-  _NAME_CACHE = {}  
+  if len(padded_date_string) == 26 and \
+      padded_date_string[3:6] in _MONTH_NUMBERS:
+    zone = (int(padded_date_string[22:24]) * 60 + 
+        int(padded_date_string[24:26])) * 60
+    if padded_date_string[21] == "-":
+      zone = -zone
+    
+    date_sec = calendar.timegm((
+        int(padded_date_string[7:11]),
+        _MONTH_NUMBERS[padded_date_string[3:6]],
+        int(padded_date_string[0:2]),
+        int(padded_date_string[12:14]),
+        int(padded_date_string[15:17]),
+        int(padded_date_string[18:20]))) - zone
+    date_tuple = time.localtime(date_sec)
+  else:
+    date_tuple = imaplib.Internaldate2tuple('INTERNALDATE "%s"' % date_string)
+    date_sec = time.mktime(date_tuple)
+  
+  return date_sec, date_tuple
+
+# Header fields that the accessors below read, so that when only some header
+# fields are fetched, callers can tell which ones they need
+SENDER_HEADER_FIELDS = ["From"]
+RECIPIENT_HEADER_FIELDS = ["To", "Cc", "Resent-To", "Resent-Cc"]
+LIST_ID_HEADER_FIELDS = ["List-Id"]
+DISPLAY_HEADER_FIELDS = ["Subject", "Message-ID"]
+
+# X-GM-LABELS uses these names for system labels that correspond to 
+# mailboxes. Other system labels (e.g. \\Sent) correspond to "[Gmail]/..."
+# mailboxes, which are not treated as labels.
+_GMAIL_SYSTEM_LABEL_MAILBOXES = {
+  "\\Inbox": "INBOX",
+}
+
+_PLUS_ADDRESS_RE = re.compile("\+.*@")
+
+_CANONICAL_ADDRESSES = {}
+
+def CanonicalizeAddress(address):
+  if address not in _CANONICAL_ADDRESSES:
+    canonical_address = address.lower()
+    canonical_address = _PLUS_ADDRESS_RE.sub("@", canonical_address)
+    _CANONICAL_ADDRESSES[address] = canonical_address
+  return _CANONICAL_ADDRESSES[address]
+
+class NameResolver(object):
+  '''Picks the name to display for an address, which is the one that it has
+  been seen with most often. The most popular name is updated as names are
+  added, so looking it up doesn't involve going over all of them.'''
+  def __init__(self, uid_validity=None):
+    self.__name_counts = {}
+    self.__popular_names = {}
+    
+    # Names from messages up to this UID have been added (used when the 
+    # resolver is kept between runs, so that names are only counted once)
+    self.uid_validity = uid_validity
+    self.last_uid = 0
+
+  def AddName(self, address, name):
+    name_counts = self.__name_counts.setdefault(address, {})
+    count = name_counts.get(name, 0) + 1
+    name_counts[name] = count
+    
+    if address not in self.__popular_names or \
+        count > name_counts[self.__popular_names[address]]:
+      self.__popular_names[address] = name
+
+  def GetName(self, address):
+    return self.__popular_names.get(address)
+
+class MessageInfo(object):
+  name_resolver = NameResolver()
   
   def __init__(self): 
     self.__message_id = None
+    self.__gmail_message_id = None
+    self.__gmail_thread_id = None
     self.__mailboxes = []
-    self.is_from_me = False
-    self.is_to_me = False
+    
+    # Dates are only parsed when they're needed (e.g. not for the messages in
+    # label mailboxes, which are only used for their IDs)
+    self.__date_sec = None
+    self.__date_tuple = None
     
     self.__parsed_name_address = {}
+    self.__parsed_recipients = None
   
   def PopulateField(self, name, value):
     if name == "UID": self.__uid = value
@@ -34,21 +140,24 @@ class MessageInfo(object):
     elif name == "FLAGS": self.__flags = value
     elif name == "INTERNALDATE":
       self.__date_string = value
-
-      if MessageInfo.__parseDates:
-        self.__date_tuple = \
-            imaplib.Internaldate2tuple('INTERNALDATE "%s"' % value)
-        
-        self.__date_sec = time.mktime(self.__date_tuple)
-        if self.__date_sec > MessageInfo.__newestMessageSec:
-          MessageInfo.__newestMessageSec = self.__date_sec
-        if self.__date_sec < MessageInfo.__oldestMessageSec:
-          MessageInfo.__oldestMessageSec = self.__date_sec
-      
-    elif name == "RFC822.HEADER": 
+      self.__date_sec = self.__date_tuple = None
+    elif name == "RFC822.HEADER" or name.startswith("BODY[HEADER.FIELDS"): 
         self.headers = email.message_from_string(value)
+    elif name == "X-GM-MSGID": self.__gmail_message_id = value
+    elif name == "X-GM-THRID": self.__gmail_thread_id = value
+    elif name == "X-GM-LABELS":
+      self.__mailboxes = []
+      for label in value:
+        if label.startswith("\\"):
+          if label in _GMAIL_SYSTEM_LABEL_MAILBOXES:
+            self.__mailboxes.append(_GMAIL_SYSTEM_LABEL_MAILBOXES[label])
+        else:
+          self.__mailboxes.append(label)
     else: raise AssertionError("unknown field: %s" % name)
 
+  def GetUid(self):
+    return int(self.__uid)
+
   def GetMessageId(self):
     if not self.__message_id:
       d = md5.new()
@@ -57,11 +166,33 @@ class MessageInfo(object):
       self.__message_id = d.digest()
     return self.__message_id
 
+  def GetGmailMessageId(self):
+    return self.__gmail_message_id
+
+  def GetGmailThreadId(self):
+    return self.__gmail_thread_id
+
   def AddMailbox(self, mailbox):
     self.__mailboxes.append(mailbox)
 
+  def GetMailboxes(self):
+    return self.__mailboxes
+  
+  def SetMailboxes(self, mailboxes):
+    self.__mailboxes = mailboxes
+
   def GetDate(self):
+    self.__ParseDate()
     return self.__date_tuple
+
+  def GetDateSec(self):
+    self.__ParseDate()
+    return self.__date_sec
+  
+  def __ParseDate(self):
+    if self.__date_sec is None:
+      self.__date_sec, self.__date_tuple = \
+          ParseInternalDate(self.__date_string)
   
   def GetSender(self):
     return self._GetNameAddress("from")
@@ -73,22 +204,26 @@ class MessageInfo(object):
     return address, address
     
   def GetRecipients(self):
-    tos = self.GetHeaderAll('to')
-    ccs = self.GetHeaderAll('cc')
-    resent_tos = self.GetHeaderAll('resent-to')
-    resent_ccs = self.GetHeaderAll('resent-cc')
-    all_recipients = email.utils.getaddresses(
-        tos + ccs + resent_tos + resent_ccs)
-    
-    # Cleaned up and uniquefied
-    recipients_map = {}
-    
-    for name, address in all_recipients:
-      if address:
-        name, address = self._GetCleanedUpNameAddress(name, address)
-        recipients_map[address] = name
+    if self.__parsed_recipients is None:
+      tos = self.GetHeaderAll('to')
+      ccs = self.GetHeaderAll('cc')
+      resent_tos = self.GetHeaderAll('resent-to')
+      resent_ccs = self.GetHeaderAll('resent-cc')
+      all_recipients = email.utils.getaddresses(
+          tos + ccs + resent_tos + resent_ccs)
+      
+      # Cleaned up and uniquefied
+      recipients_map = {}
+      
+      for name, address in all_recipients:
+        if address:
+          name, address = self._GetCleanedUpNameAddress(name, address)
+          recipients_map[address] = name
+      
+      self.__parsed_recipients = recipients_map.items()
     
-    return [(name, address) for address, name in recipients_map.items()]
+    return [(self._GetDisplayName(name, address), address) 
+        for address, name in self.__parsed_recipients]
 
   def _GetNameAddress(self, header):
     if not header in self.headers:
@@ -104,10 +239,11 @@ class MessageInfo(object):
         name, address = self._GetCleanedUpNameAddress(name, address)
         
       self.__parsed_name_address[header] = name, address
-      
-    return self.__parsed_name_address[header]
-
-  _PLUS_ADDRESS_RE = re.compile("\+.*@")
+    
+    name, address = self.__parsed_name_address[header]
+    if address:
+      name = self._GetDisplayName(name, address)
+    return name, address
 
   def GetHeader(self, name):
     return self._GetDecodedValue(self.headers[name])
@@ -123,39 +259,23 @@ class MessageInfo(object):
     return u"".join(unicode_pieces)
 
   def _GetCleanedUpNameAddress(self, name, address):
-    address = address.lower()
-    address = MessageInfo._PLUS_ADDRESS_RE.sub("@", address)
+    address = CanonicalizeAddress(address)
     
     if name == "No Description Available":
       name = None
     
-    cache = MessageInfo._NAME_CACHE
-    
-    if address in cache:
-      if name:
-        cache[address][name] = cache[address].get(name, 0) + 1
-      
-      # TODO(mihaip): cache max and compare with updated key and re-compute if
-      # necessary, instead of re-calculating every time
-      popular_name_pair = \
-          max(cache[address].items(), key=lambda pair: pair[1])
-      name = popular_name_pair[0]
-    elif name:
-        cache[address] = {}
-        cache[address][name] = 1
-    else:
-      name = address
+    # Each message's names are only counted once, when they're first parsed
+    resolver = MessageInfo.name_resolver
+    if name and self.GetUid() > resolver.last_uid:
+      resolver.AddName(address, name)
     
     return name, address
 
-  def GetDateRange():
-    return [MessageInfo.__oldestMessageSec, MessageInfo.__newestMessageSec]
-  GetDateRange = staticmethod(GetDateRange)
-  
-  def SetParseDate(parseDates):
-    MessageInfo.__parseDates = parseDates
-  SetParseDate = staticmethod(SetParseDate)
-  
+  def _GetDisplayName(self, name, address):
+    # Fall back on the message's own name (or the address) if the resolver 
+    # has no name for the address
+    return MessageInfo.name_resolver.GetName(address) or name or address
+
   def __str__(self):
     return "%s (size: %d, date: %s)" % (
         self.GetHeader("subject"), self.size, self.__date_string)
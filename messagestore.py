@@ -0,0 +1,120 @@
+# Keeps a local copy of data fetched from each mailbox, so that later runs only
+# need to fetch messages that have arrived since. Data is keyed by UID, and
+# tagged with the mailbox's UIDVALIDITY value, since UIDs are only meaningful
+# as long as that stays the same.
+
+import cPickle
+import logging
+import md5
+import os
+import tempfile
+
+import messageinfo
+import messagethreads
+
+class MessageStoreError(Exception):
+  '''Base exception class for MessageStore related errors'''
+
+class MailboxState(object):
+  def __init__(self, uid_validity):
+    self.uid_validity = uid_validity
+    # Highest UID that we have data for
+    self.last_uid = 0
+    self.values = {}
+
+  def Add(self, uid, value):
+    self.values[uid] = value
+    if uid > self.last_uid:
+      self.last_uid = uid
+
+  def Prune(self, uids):
+    # Drop data for messages that are no longer in the mailbox
+    present_uids = set(uids)
+    for uid in self.values.keys():
+      if uid not in present_uids:
+        del self.values[uid]
+
+class StatState(object):
+  def __init__(self, uid_validity):
+    self.uid_validity = uid_validity
+    # Messages up to this UID are included in the aggregates
+    self.last_uid = 0
+    self.message_count = 0
+    # Aggregate key to aggregate, for stats that can be updated incrementally
+    self.aggregates = {}
+
+class ThreadState(object):
+  def __init__(self, uid_validity):
+    self.uid_validity = uid_validity
+    # Messages up to this UID have been added to the forest
+    self.last_uid = 0
+    self.message_count = 0
+    self.forest = messagethreads.ThreadForest()
+
+class MessageStore(object):
+  def __init__(self, root_directory):
+    root_directory = os.path.abspath(root_directory)
+    if not os.path.exists(root_directory):
+      os.makedirs(root_directory)
+    if not os.path.isdir(root_directory):
+      raise MessageStoreError('%s exists but is not a directory' %
+                              root_directory)
+    self._root_directory = root_directory
+
+  def GetMailboxState(self, key, uid_validity):
+    state = self._Load(key, uid_validity)
+    if state:
+      logging.info("  Have stored data for %d messages (up to UID %d)",
+          len(state.values), state.last_uid)
+      return state
+
+    return MailboxState(uid_validity)
+
+  def SetMailboxState(self, key, state):
+    self._Save(key, state)
+
+  def GetNameResolver(self, key, uid_validity):
+    return self._Load(key, uid_validity) or \
+        messageinfo.NameResolver(uid_validity)
+
+  def SetNameResolver(self, key, resolver):
+    self._Save(key, resolver)
+
+  def GetStatState(self, key, uid_validity):
+    return self._Load(key, uid_validity) or StatState(uid_validity)
+
+  def SetStatState(self, key, state):
+    self._Save(key, state)
+
+  def GetThreadState(self, key, uid_validity):
+    return self._Load(key, uid_validity) or ThreadState(uid_validity)
+
+  def SetThreadState(self, key, state):
+    self._Save(key, state)
+
+  def _Load(self, key, uid_validity):
+    path = self._GetPath(key)
+
+    if not os.path.exists(path):
+      return None
+
+    value = cPickle.load(open(path, "rb"))
+    if value.uid_validity != uid_validity:
+      logging.info("  UIDVALIDITY changed from %s to %s, doing a full resync",
+          value.uid_validity, uid_validity)
+      return None
+    
+    return value
+
+  def _Save(self, key, value):
+    path = self._GetPath(key)
+    temp_fd, temp_path = tempfile.mkstemp(dir=self._root_directory)
+    temp_fp = os.fdopen(temp_fd, 'wb')
+    cPickle.dump(value, temp_fp, cPickle.HIGHEST_PROTOCOL)
+    temp_fp.close()
+    if os.path.exists(path):
+      os.remove(path)
+    os.rename(temp_path, path)
+
+  def _GetPath(self, key):
+    return os.path.join(self._root_directory, md5.new(key).hexdigest())
@@ -0,0 +1,305 @@
+# Compact, column-oriented storage of the message data that stats use. Instead
+# of a MessageInfo object (with all of its parsed headers) per message, values
+# are derived from the headers once, right after fetching, and kept in arrays
+# with one entry per message. Name/address pairs are stored once, and referred
+# to by their index.
+
+import array
+import time
+
+import jwzthreading
+import messageinfo
+
+class Bitset(object):
+  def __init__(self, size):
+    self.__bytes = array.array("B", [0]) * ((size + 7) / 8)
+
+  def Set(self, index):
+    self.__bytes[index >> 3] |= 1 << (index & 7)
+
+  def Get(self, index):
+    return (self.__bytes[index >> 3] >> (index & 7)) & 1 == 1
+
+class AddressTable(object):
+  '''Name/address pairs, stored once per address. Names are resolved once all
+  messages have been seen, so that every message from an address uses the 
+  same one.'''
+  def __init__(self):
+    self.__indices = {}
+    self.__pairs = []
+
+  def GetIndex(self, pair):
+    name, address = pair
+    # Pairs with no address can't be resolved, so they're kept as is
+    key = address or pair
+    if key not in self.__indices:
+      self.__indices[key] = len(self.__pairs)
+      self.__pairs.append(pair)
+    elif name and address:
+      self.__pairs[self.__indices[key]] = pair
+    return self.__indices[key]
+
+  def FindIndex(self, address):
+    return self.__indices.get(address)
+
+  def GetPair(self, index):
+    return self.__pairs[index]
+
+  def ResolveNames(self, name_resolver):
+    for index, (name, address) in enumerate(self.__pairs):
+      if address:
+        name = name_resolver.GetName(address) or name or address
+        self.__pairs[index] = name, address
+
+  def __len__(self):
+    return len(self.__pairs)
+
+class MessageTable(object):
+  def __init__(self, message_infos):
+    self.__InitColumns(len(message_infos))
+
+    self.addresses = AddressTable()
+
+    for i in xrange(len(message_infos)):
+      self.__AddMessageInfo(i, message_infos[i])
+
+    self.addresses.ResolveNames(messageinfo.MessageInfo.name_resolver)
+
+  def __InitColumns(self, count):
+    self.__count = count
+    self.__date_index = None
+
+    self.uids = array.array("l")
+    self.dates = array.array("d")
+    self.sizes = array.array("l")
+
+    # Date parts, in local time (as in time.struct_time)
+    self.years = array.array("H")
+    self.months = array.array("B")
+    self.days = array.array("B")
+    self.hours = array.array("B")
+    self.weekdays = array.array("B")
+    self.year_days = array.array("H")
+
+    # Indices into the address table
+    self.senders = array.array("l")
+    self.list_ids = array.array("l")
+    # Recipients of message i are recipients[recipient_offsets[i]:
+    # recipient_offsets[i + 1]]
+    self.recipients = array.array("l")
+    self.recipient_offsets = array.array("l", [0])
+
+    self.from_me = Bitset(count)
+    self.to_me = Bitset(count)
+
+    # X-GM-THRID values (0 for messages that don't have one)
+    self.gmail_thread_ids = array.array("L")
+
+    # Label name to the bitset of messages that have it
+    self.labels = {}
+
+    # Only needed for displaying messages
+    self.subjects = []
+    self.message_ids = []
+
+    # Message-ID, References and Subject, for threading (None for messages
+    # that have no Message-ID)
+    self.thread_messages = []
+
+  def __AddMessageInfo(self, i, message_info):
+    self.uids.append(message_info.GetUid())
+    self.dates.append(message_info.GetDateSec())
+    self.sizes.append(message_info.size)
+
+    date = message_info.GetDate()
+    self.years.append(date.tm_year)
+    self.months.append(date.tm_mon)
+    self.days.append(date.tm_mday)
+    self.hours.append(date.tm_hour)
+    self.weekdays.append(date.tm_wday)
+    self.year_days.append(date.tm_yday)
+
+    self.senders.append(self.addresses.GetIndex(message_info.GetSender()))
+    self.list_ids.append(self.addresses.GetIndex(message_info.GetListId()))
+    for pair in message_info.GetRecipients():
+      self.recipients.append(self.addresses.GetIndex(pair))
+    self.recipient_offsets.append(len(self.recipients))
+
+    self.gmail_thread_ids.append(int(message_info.GetGmailThreadId() or 0))
+
+    for mailbox in message_info.GetMailboxes():
+      self.__GetLabel(mailbox).Set(i)
+
+    self.subjects.append(message_info.GetHeader("subject"))
+    self.message_ids.append(message_info.headers["message-id"])
+
+    thread_message = jwzthreading.make_message(message_info.headers)
+    if thread_message:
+      # Don't keep a reference to the headers
+      thread_message.message = None
+    self.thread_messages.append(thread_message)
+
+  def __AddRow(self, i, table, table_index):
+    for name in _ARRAY_COLUMNS:
+      getattr(self, name).append(getattr(table, name)[table_index])
+
+    self.recipients.extend(table.recipients[
+        table.recipient_offsets[table_index]:
+        table.recipient_offsets[table_index + 1]])
+    self.recipient_offsets.append(len(self.recipients))
+
+    if table.IsFromMe(table_index): self.from_me.Set(i)
+    if table.IsToMe(table_index): self.to_me.Set(i)
+
+    for mailbox in table.GetMailboxes(table_index):
+      self.__GetLabel(mailbox).Set(i)
+
+    self.subjects.append(table.subjects[table_index])
+    self.message_ids.append(table.message_ids[table_index])
+    self.thread_messages.append(table.thread_messages[table_index])
+
+  def __GetLabel(self, mailbox):
+    if mailbox not in self.labels:
+      self.labels[mailbox] = Bitset(self.__count)
+    return self.labels[mailbox]
+
+  def Select(self, indices):
+    '''Returns a table with just the given messages.'''
+    table = MessageTable([])
+    table.__InitColumns(len(indices))
+    table.addresses = self.addresses
+
+    for i, index in enumerate(indices):
+      table.__AddRow(i, self, index)
+
+    return table
+
+  def __len__(self):
+    return len(self.sizes)
+
+  def __getitem__(self, i):
+    return MessageRow(self, i)
+
+  def GetDateIndex(self):
+    if not self.__date_index:
+      self.__date_index = DateIndex(self)
+    return self.__date_index
+
+  def GetDateRange(self):
+    if not self.dates:
+      now = time.time()
+      return [now, now]
+    date_index = self.GetDateIndex()
+    return [date_index.dates[0], date_index.dates[-1]]
+
+  def GetSender(self, i):
+    return self.addresses.GetPair(self.senders[i])
+
+  def GetListId(self, i):
+    name, address = self.addresses.GetPair(self.list_ids[i])
+    return address, address
+
+  def GetRecipients(self, i):
+    return [
+      self.addresses.GetPair(address_index)
+      for address_index in self.GetRecipientIndices(i)
+    ]
+
+  def GetRecipientIndices(self, i):
+    return self.recipients[
+        self.recipient_offsets[i]:self.recipient_offsets[i + 1]]
+
+  def IsFromMe(self, i):
+    return self.from_me.Get(i)
+
+  def IsToMe(self, i):
+    return self.to_me.Get(i)
+
+  def HasGmailThreadIds(self):
+    # Thread IDs are fetched along with labels, so either all messages have
+    # one or none do
+    return len(self) > 0 and 0 not in self.gmail_thread_ids
+
+  def GetMailboxes(self, i):
+    return [
+      mailbox for mailbox, bitset in self.labels.items() if bitset.Get(i)
+    ]
+
+# Columns with one value per message
+_ARRAY_COLUMNS = [
+  "uids", "dates", "sizes", "years", "months", "days", "hours", "weekdays",
+  "year_days", "senders", "list_ids", "gmail_thread_ids",
+]
+
+class DateIndex(object):
+  '''Messages of a table sorted by date, along with where each year, month and
+  day starts and ends, so that the messages from a period are a contiguous
+  range.'''
+  def __init__(self, table):
+    # Sorting is stable, so messages with the same date stay in table order
+    order = sorted(xrange(len(table)), key=table.dates.__getitem__)
+    
+    self.order = array.array("l", order)
+    self.dates = array.array("d", [table.dates[i] for i in order])
+    
+    # Period (a (year,), (year, month) or (year, month, day) tuple) to the
+    # [start, end) range of its messages in the order
+    self.__bounds = {}
+    
+    years = table.years
+    months = table.months
+    days = table.days
+    
+    for position, i in enumerate(order):
+      for period in [
+          (years[i],),
+          (years[i], months[i]),
+          (years[i], months[i], days[i])]:
+        if period in self.__bounds:
+          self.__bounds[period][1] = position + 1
+        else:
+          self.__bounds[period] = [position, position + 1]
+
+  def GetPeriodBounds(self, period):
+    if period not in self.__bounds:
+      return 0, 0
+    return self.__bounds[period]
+
+  def GetPeriodIndices(self, period):
+    start, end = self.GetPeriodBounds(period)
+    return self.order[start:end]
+
+class MessageRow(object):
+  '''View of a single message in a table, with the same accessors as a
+  MessageInfo (for code that deals with individual messages, such as
+  threading and formatting of messages).'''
+  def __init__(self, table, index):
+    self.__table = table
+    self.index = index
+
+  size = property(lambda self: self.__table.sizes[self.index])
+  is_from_me = property(lambda self: self.__table.IsFromMe(self.index))
+  is_to_me = property(lambda self: self.__table.IsToMe(self.index))
+
+  def GetDateSec(self):
+    return self.__table.dates[self.index]
+
+  def GetDate(self):
+    return time.localtime(self.__table.dates[self.index])
+
+  def GetSender(self):
+    return self.__table.GetSender(self.index)
+
+  def GetListId(self):
+    return self.__table.GetListId(self.index)
+
+  def GetRecipients(self):
+    return self.__table.GetRecipients(self.index)
+
+  def GetMailboxes(self):
+    return self.__table.GetMailboxes(self.index)
+
+  def GetHeader(self, name):
+    if name == "subject": return self.__table.subjects[self.index]
+    elif name == "message-id": return self.__table.message_ids[self.index]
+    else: raise AssertionError("unknown header: %s" % name)
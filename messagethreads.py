@@ -0,0 +1,566 @@
+# Threads of a mailbox, stored compactly in a ThreadTable. With a store, they
+# are kept between runs (in a ThreadForest) so that newly fetched messages can
+# be added to them without threading every message again.
+#
+# Messages are grouped into units that can be threaded independently of each
+# other. jwzthreading links messages that are connected by references, and
+# merges threads that have the same subject, so both put messages in the same
+# unit. When messages are added, only the units that they end up in are
+# threaded again (all together, with a single jwzthreading call), and the
+# other units' threads are copied over as they are.
+
+import array
+import logging
+
+import jwzthreading
+
+# Part of the key of saved forests, so that ones saved in an older format
+# aren't used
+FOREST_VERSION = 3
+
+# Dummy threads (ones whose first message is missing) with at least this many
+# children are split up
+_SPLIT_CHILD_COUNT = 10
+
+def GetThreads(thread_messages):
+  '''Threads jwzthreading messages and returns the thread containers (with
+  their subject set).'''
+  thread_dict = jwzthreading.thread(thread_messages)
+
+  containers = []
+  for subject, container in thread_dict.items():
+    # jwzthreading is too aggressive in threading by subject and will combine
+    # distinct threads that happen to have the same subject. Split them up if
+    # we have a dummy container that has lots of children at the first level.
+    if container.is_dummy() and \
+        len(container.children) >= _SPLIT_CHILD_COUNT:
+      for child_container in container.children:
+        child_container.subject = subject
+        containers.append(child_container)
+    else:
+      container.subject = subject
+      containers.append(container)
+
+  return containers
+
+def GetGmailThreads(messages):
+  '''Groups the messages in a table by their Gmail thread ID (X-GM-THRID), so
+  that threads are the same as the conversations that Gmail shows. A thread's
+  earliest message is its root, and the others are its children.'''
+  thread_indices = {}
+  for i in xrange(len(messages)):
+    thread_indices.setdefault(messages.gmail_thread_ids[i], []).append(i)
+
+  threads = ThreadTable(messages)
+  for indices in thread_indices.itervalues():
+    indices.sort(key=messages.dates.__getitem__)
+
+    root = threads.AddNode(-1, indices[0])
+    for i in indices[1:]:
+      threads.AddNode(root, i)
+
+    threads.AddThread(
+        root, jwzthreading.restrip_pat.sub("", messages.subjects[indices[0]]))
+
+  return threads
+
+def _ShiftNodes(nodes, delta):
+  # -1 (no node) stays as it is
+  if not delta:
+    return nodes
+  return array.array("l", [node == -1 and -1 or node + delta for node in nodes])
+
+class ThreadTable(object):
+  '''Threads of the messages in a table, stored as parallel arrays instead of
+  as trees of containers. Nodes are messages, or placeholders for messages
+  that are referenced but missing. A thread's nodes are added together, so
+  they're contiguous (starting with its root).'''
+  def __init__(self, messages):
+    self.__messages = messages
+
+    # Per node (-1 for no parent, child, sibling or message)
+    self.parents = array.array("l")
+    self.first_children = array.array("l")
+    self.next_siblings = array.array("l")
+    self.message_indices = array.array("l")
+    self.__last_children = array.array("l")
+
+    # Per thread. Summaries are computed once, when a thread is added, so
+    # that stats don't need to go over its nodes.
+    self.roots = array.array("l")
+    self.subjects = []
+    self.sizes = array.array("l")
+    self.depths = array.array("l")
+    self.participant_counts = array.array("l")
+    # Dates of the first and last messages
+    self.start_dates = array.array("d")
+    self.end_dates = array.array("d")
+
+  def AddNode(self, parent, message_index):
+    '''Adds a node as the last child of parent (or with no parent, if it's
+    -1) and returns its index.'''
+    node = len(self.parents)
+    self.parents.append(parent)
+    self.first_children.append(-1)
+    self.next_siblings.append(-1)
+    self.message_indices.append(message_index)
+    self.__last_children.append(-1)
+
+    if parent != -1:
+      last_child = self.__last_children[parent]
+      if last_child == -1:
+        self.first_children[parent] = node
+      else:
+        self.next_siblings[last_child] = node
+      self.__last_children[parent] = node
+
+    return node
+
+  def AddThread(self, root, subject):
+    size = 0
+    depth = 0
+    participants = set()
+    dates = []
+
+    for node, node_depth in self.Walk(root):
+      size += 1
+      depth = max(depth, node_depth + 1)
+
+      i = self.message_indices[node]
+      if i != -1:
+        name, address = self.__messages.GetSender(i)
+        if address:
+          participants.add(address)
+        dates.append(self.__messages.dates[i])
+
+    self.roots.append(root)
+    self.subjects.append(subject)
+    self.sizes.append(size)
+    self.depths.append(depth)
+    self.participant_counts.append(len(participants))
+    self.start_dates.append(dates and min(dates) or 0)
+    self.end_dates.append(dates and max(dates) or 0)
+
+  def AddContainer(self, container):
+    '''Adds a thread from a tree of jwzthreading containers, whose messages
+    have their message_info set.'''
+    nodes = {}
+    for child_container, depth in container.walk():
+      parent = -1
+      if child_container is not container:
+        parent = nodes[id(child_container.parent)]
+      message_index = -1
+      if child_container.message:
+        message_index = child_container.message.message_info.index
+      nodes[id(child_container)] = self.AddNode(parent, message_index)
+
+    self.AddThread(nodes[id(container)], container.subject)
+
+  def AddThreads(self, table, start, end):
+    '''Adds threads [start, end) of another table (and their nodes).'''
+    if start >= end:
+      return
+
+    node_start = table.roots[start]
+    if end < len(table.roots):
+      node_end = table.roots[end]
+    else:
+      node_end = len(table.parents)
+    delta = len(self.parents) - node_start
+
+    self.parents.extend(
+        _ShiftNodes(table.parents[node_start:node_end], delta))
+    self.first_children.extend(
+        _ShiftNodes(table.first_children[node_start:node_end], delta))
+    self.next_siblings.extend(
+        _ShiftNodes(table.next_siblings[node_start:node_end], delta))
+    self.message_indices.extend(table.message_indices[node_start:node_end])
+    # Copied threads are complete, so no children are added to their nodes
+    self.__last_children.extend(
+        array.array("l", [-1]) * (node_end - node_start))
+
+    self.roots.extend(_ShiftNodes(table.roots[start:end], delta))
+    self.subjects.extend(table.subjects[start:end])
+    self.sizes.extend(table.sizes[start:end])
+    self.depths.extend(table.depths[start:end])
+    self.participant_counts.extend(table.participant_counts[start:end])
+    self.start_dates.extend(table.start_dates[start:end])
+    self.end_dates.extend(table.end_dates[start:end])
+
+  def Walk(self, root):
+    '''Yields a node and all of its descendants (depth-first, in order),
+    along with their depth below it.'''
+    node = root
+    depth = 0
+    while True:
+      yield node, depth
+
+      if self.first_children[node] != -1:
+        node = self.first_children[node]
+        depth += 1
+        continue
+
+      while node != root and self.next_siblings[node] == -1:
+        node = self.parents[node]
+        depth -= 1
+      if node == root:
+        return
+      node = self.next_siblings[node]
+
+  def __len__(self):
+    return len(self.roots)
+
+  def __getitem__(self, i):
+    return ThreadRow(self, i)
+
+  def GetMessageIndex(self, i):
+    '''Index of the thread's first message in the messages table, or -1 if
+    it's missing.'''
+    return self.message_indices[self.roots[i]]
+
+  def GetMessageInfo(self, i):
+    message_index = self.GetMessageIndex(i)
+    if message_index == -1:
+      return None
+    return self.__messages[message_index]
+
+class ThreadRow(object):
+  '''View of a single thread in a table, for formatting it.'''
+  def __init__(self, table, index):
+    self.__table = table
+    self.index = index
+
+  subject = property(lambda self: self.__table.subjects[self.index])
+  size = property(lambda self: self.__table.sizes[self.index])
+  depth = property(lambda self: self.__table.depths[self.index])
+  participant_count = property(
+      lambda self: self.__table.participant_counts[self.index])
+  date_range = property(lambda self: [
+      self.__table.start_dates[self.index],
+      self.__table.end_dates[self.index]])
+  message_info = property(
+      lambda self: self.__table.GetMessageInfo(self.index))
+
+class ThreadForest(object):
+  '''Threads that are kept between runs. Messages are numbered in the order
+  that they're added (their sequence numbers), and the threads are kept in a
+  ThreadTable with sequence numbers instead of message indices. Only built-in
+  types are used, so that saving and loading the forest is fast.'''
+  def __init__(self):
+    # Per sequence number (None for messages that are no longer present)
+    self.__message_ids = []
+
+    # Units are numbered. Message-ID (of messages and of the ones that they
+    # reference) to the unit that it's in, and subject of each of a unit's
+    # threads to the unit.
+    self.__units_by_id = {}
+    self.__units_by_subject = {}
+    # Per unit
+    self.__unit_sequences = {}
+    self.__unit_message_ids = {}
+    self.__unit_subjects = {}
+    self.__next_unit = 0
+
+    self.__threads = ThreadTable(None)
+    # Per thread
+    self.__thread_units = array.array("l")
+
+  def Update(self, messages, new_indices):
+    '''Adds the messages at new_indices (and drops the ones that are no
+    longer in the messages table) and returns all threads.'''
+    indices_by_id = {}
+    for i in xrange(len(messages)):
+      thread_message = messages.thread_messages[i]
+      if thread_message:
+        indices_by_id[thread_message.message_id] = i
+    # Index of each message in the messages table (or -1 if it's missing)
+    indices = [indices_by_id.get(message_id, -1)
+        for message_id in self.__message_ids]
+
+    touched_units = set()
+    self.__DropMissingMessages(messages, indices, touched_units)
+    for i in new_indices:
+      thread_message = messages.thread_messages[i]
+      if thread_message:
+        self.__AddMessage(thread_message, i, indices, touched_units)
+
+    # If most messages need threading anyway, the forest is rebuilt (which
+    # is as fast as threading everything without a forest), so that its
+    # units are as small as they can be (units are never split up)
+    touched_message_count = 0
+    for unit in touched_units:
+      touched_message_count += len(self.__unit_sequences[unit])
+    if touched_message_count * 2 > len(messages):
+      logging.info("  Most threads have new messages, rebuilding them")
+      return self.__Rebuild(messages)
+
+    threaded_message_count = self.__ThreadUnits(
+        messages, indices, touched_units)
+
+    logging.info("  Threaded %d messages (%d of them new)",
+        threaded_message_count, len(new_indices))
+
+    threads = ThreadTable(messages)
+    threads.AddThreads(self.__threads, 0, len(self.__threads))
+    threads.message_indices = array.array("l", [
+      sequence == -1 and -1 or indices[sequence]
+      for sequence in threads.message_indices
+    ])
+    return threads
+
+  def __Rebuild(self, messages):
+    '''Threads all messages and replaces the forest with their threads.
+    Sequence numbers are the same as message indices, and units are made from
+    the threads instead of from each message's references.'''
+    self.__init__()
+    thread_messages = []
+    for i in xrange(len(messages)):
+      thread_message = messages.thread_messages[i]
+      if thread_message:
+        thread_message.message_info = messages[i]
+        thread_messages.append(thread_message)
+        self.__message_ids.append(thread_message.message_id)
+      else:
+        self.__message_ids.append(None)
+
+    threads = ThreadTable(messages)
+    # First message of each thread, to find its unit once all are merged
+    thread_message_ids = []
+    for container in GetThreads(thread_messages):
+      # Threads with the same subject were threaded together
+      unit = self.__units_by_subject.get(container.subject)
+      if unit is None:
+        unit = self.__next_unit
+        self.__next_unit += 1
+        self.__unit_sequences[unit] = []
+        self.__unit_message_ids[unit] = []
+        self.__unit_subjects[unit] = []
+
+      unit_sequences = self.__unit_sequences[unit]
+      for child_container, depth in container.walk():
+        thread_message = child_container.message
+        if not thread_message:
+          continue
+        if len(thread_message_ids) == len(threads):
+          thread_message_ids.append(thread_message.message_id)
+        unit_sequences.append(thread_message.message_info.index)
+        for message_id in \
+            [thread_message.message_id] + thread_message.references:
+          other_unit = self.__units_by_id.get(message_id)
+          if other_unit is None:
+            self.__units_by_id[message_id] = unit
+            self.__unit_message_ids[unit].append(message_id)
+          elif other_unit != unit:
+            # Only messages that are in the same thread reference each
+            # other, but units are merged in case that's not so
+            unit = self.__MergeUnits(unit, other_unit, set())
+            unit_sequences = self.__unit_sequences[unit]
+
+      self.__units_by_subject[container.subject] = unit
+      self.__unit_subjects[unit].append(container.subject)
+      threads.AddContainer(container)
+
+    self.__thread_units = array.array("l", [
+      self.__units_by_id[message_id] for message_id in thread_message_ids
+    ])
+
+    logging.info("  Threaded %d messages", len(thread_messages))
+
+    self.__threads.AddThreads(threads, 0, len(threads))
+    return threads
+
+  def __DropMissingMessages(self, messages, indices, touched_units):
+    # Messages that are no longer in the table (e.g. because only some of
+    # them were fetched) are dropped, and their units threaded again
+    for sequence, i in enumerate(indices):
+      message_id = self.__message_ids[sequence]
+      if i == -1 and message_id is not None:
+        unit = self.__units_by_id[message_id]
+        self.__unit_sequences[unit].remove(sequence)
+        self.__message_ids[sequence] = None
+        touched_units.add(unit)
+
+    # Which of their messages end up at the root of a thread can change, so
+    # they're merged with units that have any of their messages' subjects
+    for unit in list(touched_units):
+      for sequence in list(self.__unit_sequences.get(unit, [])):
+        unit = self.__MergeSubjectUnit(
+            unit, messages.thread_messages[indices[sequence]], touched_units)
+
+  def __AddMessage(self, thread_message, i, indices, touched_units):
+    sequence = len(self.__message_ids)
+    self.__message_ids.append(thread_message.message_id)
+    indices.append(i)
+
+    message_ids = [thread_message.message_id] + thread_message.references
+    unit = None
+    for message_id in message_ids:
+      other_unit = self.__units_by_id.get(message_id)
+      if other_unit is None or other_unit == unit:
+        continue
+      if unit is None:
+        unit = other_unit
+      else:
+        unit = self.__MergeUnits(unit, other_unit, touched_units)
+
+    if unit is None:
+      unit = self.__next_unit
+      self.__next_unit += 1
+      self.__unit_sequences[unit] = []
+      self.__unit_message_ids[unit] = []
+      self.__unit_subjects[unit] = []
+    self.__unit_sequences[unit].append(sequence)
+    touched_units.add(unit)
+
+    for message_id in message_ids:
+      if message_id not in self.__units_by_id:
+        self.__units_by_id[message_id] = unit
+        self.__unit_message_ids[unit].append(message_id)
+
+    # There are no threads yet when the forest is being rebuilt
+    if self.__units_by_subject:
+      self.__MergeSubjectUnit(unit, thread_message, touched_units)
+
+  def __MergeSubjectUnit(self, unit, thread_message, touched_units):
+    '''Merges a unit with the one that has threads with the message's
+    subject (if any), since the message can end up at the root of a thread.
+    This is done before threading, so that each unit is only threaded once.'''
+    subject = jwzthreading.restrip_pat.sub("", thread_message.subject)
+    other_unit = self.__units_by_subject.get(subject)
+    if other_unit is not None and other_unit != unit:
+      unit = self.__MergeUnits(unit, other_unit, touched_units)
+    return unit
+
+  def __MergeUnits(self, unit, other_unit, touched_units):
+    # The smaller unit is merged into the larger one, so that messages don't
+    # move between units too many times
+    if len(self.__unit_message_ids[unit]) < \
+        len(self.__unit_message_ids[other_unit]):
+      unit, other_unit = other_unit, unit
+
+    other_message_ids = self.__unit_message_ids.pop(other_unit)
+    for message_id in other_message_ids:
+      self.__units_by_id[message_id] = unit
+    other_subjects = self.__unit_subjects.pop(other_unit)
+    for subject in other_subjects:
+      if self.__units_by_subject.get(subject) == other_unit:
+        self.__units_by_subject[subject] = unit
+
+    self.__unit_message_ids[unit].extend(other_message_ids)
+    self.__unit_sequences[unit].extend(
+        self.__unit_sequences.pop(other_unit))
+    self.__unit_subjects[unit].extend(other_subjects)
+
+    touched_units.discard(other_unit)
+    touched_units.add(unit)
+    return unit
+
+  def __ThreadUnits(self, messages, indices, units):
+    '''Threads the messages of the given units together, replaces the units'
+    threads with the new ones and returns the number of messages threaded.'''
+    new_threads = ThreadTable(messages)
+    new_thread_units = array.array("l")
+    threaded_units = set()
+    sequences_by_index = {}
+
+    # Normally done in one go, unless the new threads turn out to have the
+    # same subject as a unit that wasn't threaded
+    while units:
+      sequences = []
+      for unit in units:
+        sequences.extend(self.__unit_sequences[unit])
+      sequences.sort()
+
+      thread_messages = []
+      for sequence in sequences:
+        i = indices[sequence]
+        sequences_by_index[i] = sequence
+        thread_message = messages.thread_messages[i]
+        thread_message.message_info = messages[i]
+        thread_messages.append(thread_message)
+      containers = GetThreads(thread_messages)
+
+      # Threads with messages from several units, or with the same subject
+      # (including ones that were split up), were threaded together, so
+      # their units are merged
+      message_ids_by_subject = {}
+      container_message_ids = []
+      for container in containers:
+        message_ids = [
+          child_container.message.message_id
+          for child_container, depth in container.walk()
+          if child_container.message
+        ]
+        if container.subject in message_ids_by_subject:
+          message_ids.append(message_ids_by_subject[container.subject])
+        else:
+          message_ids_by_subject[container.subject] = message_ids[0]
+        container_message_ids.append(message_ids[0])
+
+        unit = self.__units_by_id[message_ids[0]]
+        for message_id in message_ids[1:]:
+          other_unit = self.__units_by_id[message_id]
+          if other_unit != unit:
+            unit = self.__MergeUnits(unit, other_unit, units)
+
+      # Units that weren't threaded but have threads with the same subject
+      # are merged in, and threaded again
+      rethread_units = set()
+      for subject, message_id in message_ids_by_subject.items():
+        unit = self.__units_by_id[message_id]
+        other_unit = self.__units_by_subject.get(subject)
+        if other_unit is not None and other_unit != unit and \
+            other_unit not in units:
+          units.discard(unit)
+          rethread_units.add(unit)
+          self.__MergeUnits(unit, other_unit, rethread_units)
+
+      container_units = [
+        self.__units_by_id[message_id]
+        for message_id in container_message_ids
+      ]
+      for unit in units:
+        if unit in rethread_units:
+          continue
+        for subject in self.__unit_subjects[unit]:
+          if self.__units_by_subject.get(subject) == unit:
+            del self.__units_by_subject[subject]
+        self.__unit_subjects[unit] = []
+        threaded_units.add(unit)
+
+      for container, unit in zip(containers, container_units):
+        if unit in rethread_units:
+          continue
+        self.__units_by_subject[container.subject] = unit
+        self.__unit_subjects[unit].append(container.subject)
+        new_threads.AddContainer(container)
+        new_thread_units.append(unit)
+
+      units = rethread_units
+
+    # The other units' threads are copied over (in runs of consecutive
+    # threads), and the new ones added after them
+    threads = ThreadTable(None)
+    thread_units = array.array("l")
+    run_start = 0
+    for thread_index in xrange(len(self.__threads) + 1):
+      if thread_index < len(self.__threads):
+        unit = self.__thread_units[thread_index]
+        if unit in self.__unit_sequences and unit not in threaded_units:
+          continue
+      threads.AddThreads(self.__threads, run_start, thread_index)
+      thread_units.extend(self.__thread_units[run_start:thread_index])
+      run_start = thread_index + 1
+
+    new_nodes_start = len(threads.message_indices)
+    threads.AddThreads(new_threads, 0, len(new_threads))
+    threads.message_indices[new_nodes_start:] = array.array("l", [
+      i == -1 and -1 or sequences_by_index[i]
+      for i in threads.message_indices[new_nodes_start:]
+    ])
+    thread_units.extend(new_thread_units)
+
+    self.__threads = threads
+    self.__thread_units = thread_units
+
+    return len(sequences_by_index)
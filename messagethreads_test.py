@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import cPickle
+import unittest
+
+import jwzthreading
+import messagethreads
+
+class _Row(object):
+  def __init__(self, index):
+    self.index = index
+
+class _MessageTable(object):
+  '''The parts of a messagetable.MessageTable that threading uses.'''
+  def __init__(self, messages):
+    self.thread_messages = []
+    self.dates = []
+    for i, (message_id, references, subject) in enumerate(messages):
+      thread_message = jwzthreading.Message()
+      thread_message.message_id = message_id
+      thread_message.references = references
+      thread_message.subject = subject
+      self.thread_messages.append(thread_message)
+      self.dates.append(float(i))
+
+  def __len__(self):
+    return len(self.thread_messages)
+
+  def __getitem__(self, i):
+    return _Row(i)
+
+  def GetSender(self, i):
+    return "Sender %d" % i, "sender%d@example.com" % i
+
+def _GetThreadMessages(threads):
+  '''Indices of the messages in each thread (in a canonical order, since
+  threads and their messages can be added in any order).'''
+  thread_messages = []
+  for root in threads.roots:
+    thread_messages.append(sorted([
+      threads.message_indices[node]
+      for node, depth in threads.Walk(root)
+      if threads.message_indices[node] != -1
+    ]))
+  return sorted(thread_messages)
+
+def _GetAllThreads(messages):
+  for i, thread_message in enumerate(messages.thread_messages):
+    thread_message.message_info = messages[i]
+  threads = messagethreads.ThreadTable(messages)
+  for container in messagethreads.GetThreads(messages.thread_messages):
+    threads.AddContainer(container)
+  return threads
+
+class ThreadForestTest(unittest.TestCase):
+  _MESSAGES = [
+    ("m0", [], "Re: a"),
+    ("m1", [], "a"),
+    ("m2", [], "Re: a"),
+    ("m3", [], "a"),
+    ("m4", ["m2"], "Re: b"),
+    ("m5", ["m2", "m3"], "e"),
+    ("m6", [], "e"),
+    ("m7", ["m2", "m3", "m5"], "c"),
+    ("m8", ["m2", "m4"], "b"),
+    ("m9", ["m0", "m1"], "c"),
+    ("m10", [], "Re: b"),
+  ]
+  # Unrelated to the others, so that most threads don't get new messages and
+  # the forest isn't rebuilt
+  _OTHER_MESSAGES = [
+    ("o%d" % i, [], "other %d" % i) for i in xrange(20)
+  ]
+
+  def setUp(self):
+    self.__get_threads = messagethreads.GetThreads
+    self.__threaded_message_ids = []
+    def GetThreads(thread_messages):
+      self.__threaded_message_ids.extend(
+          [thread_message.message_id for thread_message in thread_messages])
+      return self.__get_threads(thread_messages)
+    messagethreads.GetThreads = GetThreads
+
+  def tearDown(self):
+    messagethreads.GetThreads = self.__get_threads
+
+  def testUpdateInBatches(self):
+    forest = messagethreads.ThreadForest()
+    all_messages = self._OTHER_MESSAGES + self._MESSAGES
+    for start, end in [(0, 20), (20, 22), (22, 30), (30, 31)]:
+      # Saved forests are pickled between runs
+      forest = cPickle.loads(cPickle.dumps(forest, cPickle.HIGHEST_PROTOCOL))
+      messages = _MessageTable(all_messages[:end])
+      del self.__threaded_message_ids[:]
+      threads = forest.Update(messages, range(start, end))
+
+      # Each message is threaded at most once, and the other messages'
+      # threads are kept as they are
+      threaded_message_ids = self.__threaded_message_ids
+      self.assertEqual(
+          len(set(threaded_message_ids)), len(threaded_message_ids))
+      if start:
+        self.assertEqual(
+            [], [message_id for message_id in threaded_message_ids
+                 if message_id.startswith("o")])
+
+      # Same as threading all messages at once
+      self.assertEqual(
+          _GetThreadMessages(_GetAllThreads(messages)),
+          _GetThreadMessages(threads))
+
+  def testUpdateWithSubjectOfOtherThread(self):
+    forest = messagethreads.ThreadForest()
+    forest.Update(
+        _MessageTable(self._OTHER_MESSAGES), range(len(self._OTHER_MESSAGES)))
+
+    # The new message is threaded together with the thread that has its
+    # subject, in a single go
+    messages = _MessageTable(self._OTHER_MESSAGES + [("n0", [], "other 3")])
+    del self.__threaded_message_ids[:]
+    threads = forest.Update(messages, [len(self._OTHER_MESSAGES)])
+    self.assertEqual(["n0", "o3"], sorted(self.__threaded_message_ids))
+    self.assertEqual(
+        _GetThreadMessages(_GetAllThreads(messages)),
+        _GetThreadMessages(threads))
+
+  def testUpdateWithMissingMessages(self):
+    forest = messagethreads.ThreadForest()
+    forest.Update(_MessageTable(self._MESSAGES), range(len(self._MESSAGES)))
+
+    # Messages that were added before may no longer be fetched (e.g. with
+    # max_messages)
+    messages = _MessageTable(self._MESSAGES[2:])
+    threads = forest.Update(messages, [])
+
+    message_indices = [i for i in threads.message_indices if i != -1]
+    self.assertEqual(range(len(messages)), sorted(message_indices))
+    self.assertEqual(
+        _GetThreadMessages(_GetAllThreads(messages)),
+        _GetThreadMessages(threads))
+
+  def testUpdateWithMostThreadsChanged(self):
+    forest = messagethreads.ThreadForest()
+    forest.Update(_MessageTable(self._MESSAGES[:2]), range(2))
+
+    # The forest is rebuilt, threading each message once
+    messages = _MessageTable(self._MESSAGES)
+    del self.__threaded_message_ids[:]
+    threads = forest.Update(messages, range(2, len(messages)))
+    self.assertEqual(
+        sorted([message_id for message_id, references, subject
+                in self._MESSAGES]),
+        sorted(self.__threaded_message_ids))
+    self.assertEqual(
+        _GetThreadMessages(_GetAllThreads(messages)),
+        _GetThreadMessages(threads))
+
+    # And can still be updated afterwards
+    messages = _MessageTable(self._MESSAGES + self._OTHER_MESSAGES[:1])
+    threads = forest.Update(messages, [len(self._MESSAGES)])
+    self.assertEqual(
+        _GetThreadMessages(_GetAllThreads(messages)),
+        _GetThreadMessages(threads))
+
+if __name__ == "__main__":
+  unittest.main()
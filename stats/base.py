@@ -4,7 +4,8 @@ import heapq
 import sys
 import time
 
-from Cheetah.Template import Template
+from templates import GetTemplate, WriteTemplate
+import messageinfo
 from pygooglechart import ExtendedData
 from pygooglechart import SimpleData
 
@@ -35,9 +36,61 @@ def GetDisplaySize(bytes):
       return "%.2fK" % (float(bytes)/float(1 << 10))
 
   return str(bytes)
+
+class SpaceSavingCounter(object):
+  '''Approximate counts of the most frequent keys, using at most capacity
+  counters (the Space-Saving algorithm). When all counters are in use, a new
+  key takes over the one with the lowest count (and starts from that count),
+  so the counts of frequent keys are never underestimated.'''
+  def __init__(self, capacity):
+    self.__capacity = capacity
+    self.__counts = {}
+    # (count, key) entries, including out of date ones (counts only go up, so
+    # these are never mistaken for the lowest current count)
+    self.__heap = []
+
+  def Add(self, key, count=1):
+    '''Returns the key whose counter was taken over, if any.'''
+    evicted_key = None
+    
+    if key in self.__counts:
+      self.__counts[key] += count
+    elif len(self.__counts) < self.__capacity:
+      self.__counts[key] = count
+    else:
+      evicted_key, min_count = self.__PopMin()
+      del self.__counts[evicted_key]
+      self.__counts[key] = min_count + count
+    
+    heapq.heappush(self.__heap, (self.__counts[key], key))
+    
+    # Drop out of date entries once they start to dominate
+    if len(self.__heap) > 4 * self.__capacity:
+      self.__heap = [(c, k) for k, c in self.__counts.items()]
+      heapq.heapify(self.__heap)
+    
+    return evicted_key
+
+  def GetCounts(self):
+    return self.__counts
+
+  def __PopMin(self):
+    while True:
+      count, key = heapq.heappop(self.__heap)
+      if self.__counts.get(key) == count:
+        return key, count
+
+AGGREGATE_VERSION = 2
+
+# Period that a stat can ask to be given all messages from (see 
+# Stat.GetMessagePeriod). Other periods are (year,) and (year, month) tuples.
+ALL_MESSAGES = ()
   
 class Stat(object):
   _IdIndex = 0
+  
+  # Message header fields that the stat reads
+  _HEADER_FIELDS = []
 
   def __init__(self):
     self.id = "stat-%d" % Stat._IdIndex
@@ -46,6 +99,51 @@ class Stat(object):
   def IsEmpty(self):
     return False
   
+  def GetHeaderFields(self):
+    return self._HEADER_FIELDS
+
+  def GetMessagePeriod(self):
+    '''Period whose messages should be given to ProcessMessage, or None if the
+    stat doesn't look at individual messages.'''
+    return None
+
+  def ProcessMessage(self, messages, i):
+    pass
+
+  def ProcessMessages(self, messages, indices):
+    # Stats that can handle a batch of messages at once can override this
+    for i in indices:
+      self.ProcessMessage(messages, i)
+
+  def FinishProcessing(self, messages, threads):
+    pass
+
+  # Stats that process messages can have them split up between several 
+  # copies of the stat (e.g. in different processes). Each copy's state can
+  # be gotten as an aggregate (made up of built-in types, so that it can be 
+  # pickled) and merged into another copy. AGGREGATE_VERSION should be 
+  # changed when the contents of an aggregate change, so that saved ones
+  # aren't used.
+  def GetAggregate(self):
+    return None
+
+  def MergeAggregate(self, aggregate):
+    pass
+
+  def IsIncremental(self):
+    '''Whether the stat's aggregate can be saved and later updated with just 
+    the messages that have arrived since. Other stats are recomputed.'''
+    return False
+
+  def GetAggregateKey(self):
+    # Identifies the stat's saved aggregate between runs
+    return "%s-%s" % (self.__class__.__name__, self.GetMessagePeriod())
+
+  def WriteHtml(self, out):
+    # Groups override this to write their stats' HTML as it's generated, so
+    # that the whole page doesn't have to be kept in memory
+    out.write(self.GetHtml())
+  
 class ChartStat(Stat):
   def __init__(self):
     Stat.__init__(self)
@@ -92,12 +190,12 @@ class TitleStat(Stat):
     
     self.__message_count = 0
   
-  def ProcessMessageInfos(self, message_infos, threads):
-    self.__message_count = len(message_infos)
+  def FinishProcessing(self, messages, threads):
+    self.__message_count = len(messages)
     self.__thread_count = len(threads)
   
   def GetHtml(self):
-    t = Template(
+    t = GetTemplate(
         file="templates/title-stat.tmpl",
         searchList = {
           "start": self.__start,
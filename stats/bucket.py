@@ -1,9 +1,36 @@
+import array
+import bisect
+
 from pygooglechart import StackedVerticalBarChart, Axis
 
 from base import *
 
 _Y_AXIS_SPACE = 36
 
+# Histograms are computed for a batch of values at a time, with a single pass
+# over the values.
+
+def GetColumnValues(column, indices):
+  return array.array(column.typecode, map(column.__getitem__, indices))
+
+def CountValues(values, first_value, value_count):
+  '''Counts of each value in [first_value, first_value + value_count) (other
+  values are ignored).'''
+  counts = [0] * value_count
+  for v in values:
+    offset = v - first_value
+    if 0 <= offset < value_count:
+      counts[offset] += 1
+  return counts
+
+def CountThresholds(values, thresholds):
+  '''Counts of values that are at least thresholds[i] but less than
+  thresholds[i + 1] (or at least the last threshold).'''
+  sorted_values = sorted(values)
+  starts = [bisect.bisect_left(sorted_values, t) for t in thresholds]
+  ends = starts[1:] + [len(sorted_values)]
+  return [end - start for start, end in zip(starts, ends)]
+
 class BucketStat(ChartStat):
   def __init__(self, bucket_count, title, width, height):
     ChartStat.__init__(self) 
@@ -15,20 +42,25 @@ class BucketStat(ChartStat):
     self.__width = width
     self.__height = height
  
-  def _GetBucketCollection(self, message_infos, threads):
-    return message_infos
+  def GetMessagePeriod(self):
+    return ALL_MESSAGES
  
-  def ProcessMessageInfos(self, message_infos, threads):
-    for bucket_obj in self._GetBucketCollection(message_infos, threads):
-      bucket = self._GetBucket(bucket_obj)
-      
-      if bucket is None: continue
-      
-      self.__buckets[bucket] += 1
-      
-      v = self.__buckets[bucket]
-      if v > self.__max:
-        self.__max = v
+  def ProcessMessages(self, messages, indices):
+    self._AddToBuckets(self._GetBucketCounts(messages, indices))
+
+  def _AddToBuckets(self, counts):
+    for bucket, count in enumerate(counts):
+      self.__buckets[bucket] += count
+    self.__max = max(self.__buckets)
+
+  def IsIncremental(self):
+    return True
+
+  def GetAggregate(self):
+    return self.__buckets
+
+  def MergeAggregate(self, buckets):
+    self._AddToBuckets(buckets)
    
   def GetHtml(self):
     max = self._GetRescaledMax(self.__max)
@@ -54,7 +86,7 @@ class BucketStat(ChartStat):
     
     # We render the title in the template instead of in the chart, to give
     # stat collections and individual stats similar appearance
-    t = Template(
+    t = GetTemplate(
         file="templates/bucket-stat.tmpl",
         searchList = {
           "id": self.id,
@@ -69,8 +101,8 @@ class TimeOfDayStat(BucketStat):
   def __init__(self):
     BucketStat.__init__(self, 24, 'Time of day', 400, 200)
   
-  def _GetBucket(self, message_info):
-    return message_info.GetDate().tm_hour
+  def _GetBucketCounts(self, messages, indices):
+    return CountValues(GetColumnValues(messages.hours, indices), 0, 24)
 
   def _GetBucketLabels(self):
     return ['Midnight', '', '', '', '', '',
@@ -83,9 +115,10 @@ class DayOfWeekStat(BucketStat):
     BucketStat.__init__(self, 7, 'Day of week', 300, 200)
 
   
-  def _GetBucket(self, message_info):
+  def _GetBucketCounts(self, messages, indices):
+    counts = CountValues(GetColumnValues(messages.weekdays, indices), 0, 7)
     # In the time tuple Monday is 0, but we want Sunday to be 0
-    return (message_info.GetDate().tm_wday + 1) % 7
+    return counts[-1:] + counts[:-1]
     
     
   def _GetBucketLabels(self):
@@ -100,8 +133,16 @@ class YearStat(BucketStat):
     BucketStat.__init__(
         self, len(self.__years), "Year", width, 200)
     
-  def _GetBucket(self, message_info):
-    return message_info.GetDate().tm_year - self.__years[0]
+  def GetAggregateKey(self):
+    # Buckets are relative to the first year, so they can only be reused if 
+    # the range is the same
+    return "%s-%s" % (BucketStat.GetAggregateKey(self), self.__years)
+
+  def _GetBucketCounts(self, messages, indices):
+    return CountValues(
+        GetColumnValues(messages.years, indices), 
+        self.__years[0], 
+        len(self.__years))
   
   def _GetBucketLabels(self):
     return [str(x) for x in self.__years]
@@ -112,13 +153,11 @@ class MonthStat(BucketStat):
     # No title is necessary, since the stat collection provides one
     BucketStat.__init__(self, 12, None, 300, 200)
 
-  def _GetBucket(self, message_info):
-    date = message_info.GetDate()
-    
-    if date.tm_year == self.__year:
-      return date.tm_mon - 1
-    else:
-      return None
+  def GetMessagePeriod(self):
+    return (self.__year,)
+
+  def _GetBucketCounts(self, messages, indices):
+    return CountValues(GetColumnValues(messages.months, indices), 1, 12)
       
   def _GetBucketLabels(self):
     return MONTH_NAMES
@@ -135,14 +174,13 @@ class DayStat(BucketStat):
         None, 
         500,
         200)
+
+  def GetMessagePeriod(self):
+    return (self.__year, self.__month)
         
-  def _GetBucket(self, message_info):
-    date = message_info.GetDate()
-    
-    if date.tm_year == self.__year and date.tm_mon == self.__month:
-      return date.tm_mday - 1
-    else:
-      return None
+  def _GetBucketCounts(self, messages, indices):
+    return CountValues(
+        GetColumnValues(messages.days, indices), 1, self.__days_in_month)
       
   def _GetBucketLabels(self):
     return [str(d) for d in range(1, self.__days_in_month + 1)]
@@ -175,12 +213,9 @@ class SizeBucketStat(BucketStat):
       500,
       200)
 
-  def _GetBucket(self, message_info):
-    size = message_info.size
-    
-    for i in reversed(xrange(0, len(SizeBucketStat._SIZE_BUCKETS))):
-      if size >= SizeBucketStat._SIZE_BUCKETS[i]:
-        return i
+  def _GetBucketCounts(self, messages, indices):
+    return CountThresholds(
+        GetColumnValues(messages.sizes, indices), SizeBucketStat._SIZE_BUCKETS)
   
   def _GetBucketLabels(self):
     return [GetDisplaySize(s) for s in SizeBucketStat._SIZE_BUCKETS]
@@ -214,15 +249,15 @@ class ThreadSizeBucketStat(BucketStat):
       500,
       200)
       
-  def _GetBucketCollection(self, message_infos, threads):
-    return threads      
-  
-  def _GetBucket(self, thread):
-    size = len(thread)
-    
-    for i in reversed(xrange(0, len(ThreadSizeBucketStat._SIZE_BUCKETS))):
-      if size >= ThreadSizeBucketStat._SIZE_BUCKETS[i]:
-        return i
+  def GetMessagePeriod(self):
+    return None
+
+  def IsIncremental(self):
+    return False
+
+  def FinishProcessing(self, messages, threads):
+    self._AddToBuckets(CountThresholds(
+        threads.sizes, ThreadSizeBucketStat._SIZE_BUCKETS))
 
   def _GetBucketLabels(self):
     return [str(s) for s in ThreadSizeBucketStat._SIZE_BUCKETS]    
\ No newline at end of file
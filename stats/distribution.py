@@ -1,3 +1,4 @@
+import array
 import math
 
 from pygooglechart import ExtendedData, SimpleLineChart, Axis
@@ -17,56 +18,109 @@ _FILL_COLORS = [
   'F0F071',
 ]
 
+def SmoothLine(points, start, end, window_size):
+  '''Averages each point in [start, end] with up to window_size - 1 points 
+  before it (that are also in the range). Points outside the range are 0.'''
+  smoothed = [0] * len(points)
+  
+  # Sums of the points in the range, so that any window's sum is a difference
+  prefix_sums = [0]
+  for point in points[start:end + 1]:
+    prefix_sums.append(prefix_sums[-1] + point)
+  
+  for i in xrange(start, end + 1):
+    window_start = max(start, i - window_size + 1)
+    window_sum = prefix_sums[i - start + 1] - prefix_sums[window_start - start]
+    smoothed[i] = round(window_sum/(i - window_start + 1))
+  
+  return smoothed
+
 class Distribution(ChartStat):
-  _BUCKET_SIZE = 5
-  _BUCKET_COUNT = int(math.floor(365/_BUCKET_SIZE))
+  # Days per bucket, and buckets per smoothing window
+  bucket_size = 5
+  window_size = 5
+  
+  # Only the top addresses are charted, so addresses are counted 
+  # approximately, with at most this many counters (and per-bucket counts 
+  # only for the addresses that have one)
+  _COUNTER_BUDGET = 200
 
   def __init__(self, year, css_class):
     ChartStat.__init__(self)
     
     self.__year = year
     self.__css_class = css_class
-    self.__buckets = [{} for i in xrange(0, ListDistribution._BUCKET_COUNT)]
+    self.__bucket_size = Distribution.bucket_size
+    self.__bucket_count = int(math.floor(365/self.__bucket_size))
     self.__min_bucket = sys.maxint
     self.__max_bucket = -sys.maxint - 1
-    self.__all_addresses = {}
+    self.__address_counter = SpaceSavingCounter(Distribution._COUNTER_BUDGET)
+    # Address to its count in each bucket
+    self.__address_buckets = {}
     self.__address_names = {}
    
-  def ProcessMessageInfos(self, message_infos, threads):
-    for message_info in message_infos:
-      date = message_info.GetDate()
-      
-      if date.tm_year != self.__year: continue
+  def GetMessagePeriod(self):
+    return (self.__year,)
 
-      bucket_index = (date.tm_yday - 1) / Distribution._BUCKET_SIZE
+  def ProcessMessage(self, messages, i):
+    bucket_index = (messages.year_days[i] - 1) / self.__bucket_size
+    
+    # Ignore the last partial bucket of the year
+    if bucket_index >= self.__bucket_count: return
+
+    for name, address in self._GetAddresses(messages, i):
+      if not address: continue
+      
+      if bucket_index > self.__max_bucket: self.__max_bucket = bucket_index
+      if bucket_index < self.__min_bucket: self.__min_bucket = bucket_index
       
-      # Ignore the last partial week bucket of the year
-      if bucket_index >= Distribution._BUCKET_COUNT: continue
+      self.__GetAddressBuckets(address, name, 1)[bucket_index] += 1
 
-      for name, address in self._GetAddresses(message_info):
-        self.__address_names[address] = name
-        
-        if not address: continue
-  
-        self.__all_addresses[address] = \
-            self.__all_addresses.get(address, 0) + 1
-  
-        bucket = self.__buckets[bucket_index]
-        
-        if bucket_index > self.__max_bucket: self.__max_bucket = bucket_index
-        if bucket_index < self.__min_bucket: self.__min_bucket = bucket_index
-        
-        bucket[address] = bucket.get(address, 0) + 1
+  def __GetAddressBuckets(self, address, name, count):
+    evicted_address = self.__address_counter.Add(address, count)
+    if evicted_address is not None:
+      del self.__address_buckets[evicted_address]
+      del self.__address_names[evicted_address]
+    
+    self.__address_names[address] = name
+    
+    if address not in self.__address_buckets:
+      self.__address_buckets[address] = \
+          array.array("l", [0]) * self.__bucket_count
+    return self.__address_buckets[address]
+
+  def IsIncremental(self):
+    return True
+
+  def GetAggregate(self):
+    return (self.__min_bucket, self.__max_bucket,
+        self.__address_counter.GetCounts(), self.__address_buckets, 
+        self.__address_names)
+
+  def MergeAggregate(self, aggregate):
+    min_bucket, max_bucket, address_counts, address_buckets, address_names = \
+        aggregate
+    
+    self.__min_bucket = min(self.__min_bucket, min_bucket)
+    self.__max_bucket = max(self.__max_bucket, max_bucket)
+    
+    for address, count in address_counts.items():
+      buckets = self.__GetAddressBuckets(
+          address, address_names[address], count)
+      for bucket_index, bucket_count in enumerate(address_buckets[address]):
+        buckets[bucket_index] += bucket_count
 
   def IsEmpty(self):
-    return len(self.__all_addresses) == 0
+    return len(self.__address_counter.GetCounts()) == 0
 
   def GetHtml(self):
     if self.IsEmpty(): return ""
     
     # Determine top 10 addresses
-    top_addresses = \
-        [(count, address) for (address, count) in self.__all_addresses.items()]
+    top_addresses = [
+      (count, address) 
+      for (address, count) in self.__address_counter.GetCounts().items()
+    ]
     top_addresses.sort(reverse=True)
     top_addresses = [address for (count, address) in top_addresses]
     
@@ -75,51 +129,28 @@ class Distribution(ChartStat):
     
     top_addresses.reverse()
 
-    # Collect lines for each address
-    bucket_lines = {}
+    # Stack the top addresses' counts in each bucket (the rows of the 
+    # buckets x addresses matrix), normalized to add up to 1.0
+    max_value = ExtendedData.max_value()
+    lines = [[] for address in top_addresses]
     
-    for bucket in self.__buckets:
-      sum = 0
-      for address in top_addresses:
-        sum += bucket.get(address, 0)
-      
-      sum = float(sum)
+    for bucket_counts in zip(*[
+        self.__address_buckets[address] for address in top_addresses]):
+      total = float(sum(bucket_counts))
       fraction_sum = 0
       
-      for address in top_addresses:
-        if sum == 0:
-          fraction = 0
-        else:
-          fraction = bucket.get(address, 0)/sum
+      for line, count in zip(lines, bucket_counts):
+        if total:
+          fraction_sum += count/total
+        line.append(round(fraction_sum * max_value))
       
-        fraction_sum += fraction
-        
-        # Make sure everything adds up to 1.0
-        if address == top_addresses[-1]:
-          fraction_sum = 1.0
-        
-        if address not in bucket_lines:
-          bucket_lines[address] = []
-
-        bucket_lines[address].append(round(
-            fraction_sum * ExtendedData.max_value()))
-
-    # Smooth lines
-    for address, points in bucket_lines.items():
-      smoothed = []
-      window = []
-      window_sum = 0
-      for i in xrange(0, len(points)):
-        if i < self.__min_bucket or i > self.__max_bucket:
-          smoothed.append(0)
-        else:
-          point = points[i]
-          if len(window) == Distribution._BUCKET_SIZE:
-            window_sum -= window.pop(0)
-          window.append(point)
-          window_sum += point
-          smoothed.append(round(window_sum/len(window)))
-      bucket_lines[address] = smoothed
+      # Make sure everything adds up to 1.0
+      lines[-1][-1] = round(1.0 * max_value)
+    
+    bucket_lines = {}
+    for address, points in zip(top_addresses, lines):
+      bucket_lines[address] = SmoothLine(
+          points, self.__min_bucket, self.__max_bucket, Distribution.window_size)
     
     # Generate chart
     chart = SimpleLineChart(450, 250)
@@ -150,7 +181,7 @@ class Distribution(ChartStat):
     chart.set_colours(colors)
     chart.set_axis_labels(Axis.BOTTOM, MONTH_NAMES)
 
-    t = Template(
+    t = GetTemplate(
         file="templates/distribution.tmpl",
         searchList = {
           "id": self.id,
@@ -163,43 +194,53 @@ class Distribution(ChartStat):
     return unicode(t)
 
 class SenderDistribution(Distribution):
+  _HEADER_FIELDS = messageinfo.SENDER_HEADER_FIELDS
+  
   def __init__(self, year):
     Distribution.__init__(self, year, "sender")
   
-  def _GetAddresses(self, message_info):
-    return [message_info.GetSender()]
+  def _GetAddresses(self, messages, i):
+    return [messages.GetSender(i)]
 
 class RecipientDistribution(Distribution):
+  _HEADER_FIELDS = messageinfo.RECIPIENT_HEADER_FIELDS
+  
   def __init__(self, year):
     Distribution.__init__(self, year, "recipient")
   
-  def _GetAddresses(self, message_info):
-    return message_info.GetRecipients()
+  def _GetAddresses(self, messages, i):
+    return messages.GetRecipients(i)
     
 class ListDistribution(Distribution):
+  _HEADER_FIELDS = messageinfo.LIST_ID_HEADER_FIELDS
+  
   def __init__(self, year):
     Distribution.__init__(self, year, "list")
     
-  def _GetAddresses(self, message_info):
-    return [message_info.GetListId()]
+  def _GetAddresses(self, messages, i):
+    return [messages.GetListId(i)]
     
 class MeRecipientDistribution(Distribution):
+  _HEADER_FIELDS = messageinfo.RECIPIENT_HEADER_FIELDS
+  
   def __init__(self, year):
     Distribution.__init__(self, year, "recipient")
   
-  def _GetAddresses(self, message_info):
-    if message_info.is_from_me:
-      return message_info.GetRecipients()
+  def _GetAddresses(self, messages, i):
+    if messages.IsFromMe(i):
+      return messages.GetRecipients(i)
     else:
       return []
     
     
 class MeSenderDistribution(Distribution):
+  _HEADER_FIELDS = messageinfo.SENDER_HEADER_FIELDS
+  
   def __init__(self, year):
     Distribution.__init__(self, year, "sender")
   
-  def _GetAddresses(self, message_info):
-    if message_info.is_to_me:
-      return [message_info.GetSender()]    
+  def _GetAddresses(self, messages, i):
+    if messages.IsToMe(i):
+      return [messages.GetSender(i)]    
     else:
       return []
\ No newline at end of file
@@ -1,3 +1,6 @@
+import multiprocessing
+import StringIO
+
 from base import *
 from bucket import *
 from distribution import *
@@ -10,10 +13,20 @@ class StatGroup(Stat):
   def _AddStat(self, stat):
     self._stats.append(stat)
   
-  def ProcessMessageInfos(self, message_infos, threads):
+  def GetHeaderFields(self):
+    header_fields = []
     for stat in self._stats:
       if stat:
-        stat.ProcessMessageInfos(message_infos, threads) 
+        header_fields.extend(stat.GetHeaderFields())
+    return header_fields
+  
+  def GetStats(self):
+    return [stat for stat in self._stats if stat]
+
+  def GetHtml(self):
+    out = StringIO.StringIO()
+    self.WriteHtml(out)
+    return out.getvalue()
 
 class StatCollection(StatGroup):
   def __init__(self, title):
@@ -29,7 +42,7 @@ class StatCollection(StatGroup):
     self._AddStat(None)
     self.__stat_titles.append(None)
   
-  def GetHtml(self):
+  def WriteHtml(self, out):
     all_empty = True
     
     for stat in self._stats:
@@ -37,16 +50,17 @@ class StatCollection(StatGroup):
         all_empty = False
         break
     
-    if all_empty: return ""
+    if all_empty: return
     
-    t = Template(
+    WriteTemplate(
+        out,
         file="templates/stat-collection.tmpl", 
         searchList = {
           "collection": self, 
           "stats": self._stats,
-          "titles": self.__stat_titles
+          "titles": self.__stat_titles,
+          "out": out
         })
-    return unicode(t)
 
 class MonthStatCollection(StatCollection):
   def __init__(self, date_range):
@@ -117,11 +131,11 @@ class StatColumnGroup(StatGroup):
     for stat in args:
       self._AddStat(stat)
 
-  def GetHtml(self):
-    t = Template(
+  def WriteHtml(self, out):
+    WriteTemplate(
+        out,
         file="templates/stat-column-group.tmpl", 
-        searchList = {"stats": self._stats})
-    return unicode(t)
+        searchList = {"stats": self._stats, "out": out})
     
 class StatTabGroup(StatGroup):
   def __init__(self, *tabs):
@@ -137,14 +151,15 @@ class StatTabGroup(StatGroup):
       
       self.__tabs.append(StatTab(title, stats))
   
-  def GetHtml(self):
-    t = Template(
+  def WriteHtml(self, out):
+    WriteTemplate(
+        out,
         file="templates/stat-tab-group.tmpl",
         searchList = {
           "id": self.id,
           "tabs": self.__tabs,
+          "out": out
         })
-    return unicode(t)    
 
 class StatTab(object):
   _IdIndex = 0
@@ -154,4 +169,114 @@ class StatTab(object):
     self.stats = stats
     
     self.id = "tab-%d" % StatTab._IdIndex
-    StatTab._IdIndex += 1
\ No newline at end of file
+    StatTab._IdIndex += 1
+
+class StatDispatcher(object):
+  '''Processes a set of stats (and the stats in any groups) together. Each 
+  message is only given to the stats that asked for its period: stats for a 
+  year or month go over just that period's range of the message table's date 
+  index, instead of every stat going over all messages and skipping the ones 
+  that it doesn't need.
+  
+  Messages can also be split up into shards that are processed by a pool of 
+  worker processes, with the stats' aggregates from each shard merged back.'''
+  def __init__(self, stats):
+    self.__stats = []
+    self.__message_stats = []
+    
+    # Stats by period, for each period length (all messages, year and month)
+    self.__period_stats = [{}, {}, {}]
+
+    for stat in stats:
+      self.__AddStat(stat)
+    
+  def __AddStat(self, stat):
+    if isinstance(stat, StatGroup):
+      for child_stat in stat.GetStats():
+        self.__AddStat(child_stat)
+      return
+    
+    self.__stats.append(stat)
+    
+    period = stat.GetMessagePeriod()
+    if period is not None:
+      self.__message_stats.append(stat)
+      self.__period_stats[len(period)].setdefault(period, []).append(stat)
+
+  def GetStats(self):
+    return self.__stats
+
+  def ProcessMessageInfos(self, messages, threads, process_count=1):
+    self.ProcessMessages(messages, process_count)
+    self.FinishProcessing(messages, threads)
+
+  def ProcessMessages(self, messages, process_count=1):
+    if process_count > 1 and len(messages) > process_count:
+      self.__ProcessInPool(messages, process_count)
+    else:
+      self.ProcessShard(messages, 0, len(messages))
+
+  def FinishProcessing(self, messages, threads):
+    for stat in self.__stats:
+      stat.FinishProcessing(messages, threads)
+
+  def ProcessShard(self, messages, start, end):
+    '''Processes the messages in the [start, end) range of the date index.'''
+    date_index = messages.GetDateIndex()
+    
+    all_stats = self.__period_stats[0].get(ALL_MESSAGES, [])
+    ProcessMessageRange(all_stats, messages, date_index, start, end)
+    
+    for period_stats in self.__period_stats[1:]:
+      for period, stats in period_stats.items():
+        period_start, period_end = date_index.GetPeriodBounds(period)
+        ProcessMessageRange(
+            stats,
+            messages,
+            date_index,
+            max(start, period_start),
+            min(end, period_end))
+
+  def GetAggregates(self):
+    return [stat.GetAggregate() for stat in self.__message_stats]
+
+  def __ProcessInPool(self, messages, process_count):
+    global _pool_dispatcher, _pool_messages
+    
+    shard_size = (len(messages) + process_count - 1) / process_count
+    shards = [
+      (start, min(start + shard_size, len(messages)))
+      for start in xrange(0, len(messages), shard_size)
+    ]
+    
+    # Workers are forked, so they get the dispatcher (and its stats) and the
+    # messages without them having to be pickled
+    _pool_dispatcher = self
+    _pool_messages = messages
+    pool = multiprocessing.Pool(process_count)
+    try:
+      shard_aggregates = pool.map(_ProcessPoolShard, shards)
+    finally:
+      pool.close()
+      pool.join()
+      _pool_dispatcher = None
+      _pool_messages = None
+    
+    for aggregates in shard_aggregates:
+      for stat, aggregate in zip(self.__message_stats, aggregates):
+        stat.MergeAggregate(aggregate)
+
+_pool_dispatcher = None
+_pool_messages = None
+
+def _ProcessPoolShard(shard):
+  start, end = shard
+  _pool_dispatcher.ProcessShard(_pool_messages, start, end)
+  return _pool_dispatcher.GetAggregates()
+
+def ProcessMessageRange(stats, messages, date_index, start, end):
+  if start >= end: return
+  
+  indices = date_index.order[start:end]
+  for stat in stats:
+    stat.ProcessMessages(messages, indices)
@@ -14,7 +14,7 @@ class SubjectSenderFormatter(object):
     self.css_class = "message"
   
   def Format(self, message_info):
-    t = Template(
+    t = GetTemplate(
         file="templates/subject-sender-formatter.tmpl",
         searchList = {
           "message_info": message_info,
@@ -31,14 +31,11 @@ class TableStat(Stat):
     
     self.__formatters = formatters
 
-  def ProcessMessageInfos(self, message_infos, threads):
-    data = self._GetTableData(message_infos, threads)
-  
-    heapq.heapify(data)
-    
-    table_data = []
-    for i in range(0, min(len(data), TableStat._TABLE_SIZE)):
-      table_data.append(heapq.heappop(data))
+  def FinishProcessing(self, messages, threads):
+    # Table data can be any iterable, only the top entries are kept while 
+    # going through it
+    table_data = heapq.nsmallest(
+        TableStat._TABLE_SIZE, self._GetTableData(messages, threads))
     
     self.__display_data = self._GetDisplayData(table_data)
 
@@ -48,7 +45,7 @@ class TableStat(Stat):
   def GetHtml(self):
     if self.IsEmpty(): return ""
     
-    t = Template(
+    t = GetTemplate(
         file="templates/table-stat.tmpl",
         searchList = {
           "id": self.id,
@@ -59,17 +56,51 @@ class TableStat(Stat):
     return unicode(t)
 
 class SizeTableStat(TableStat):
+  _HEADER_FIELDS = \
+      messageinfo.DISPLAY_HEADER_FIELDS + messageinfo.SENDER_HEADER_FIELDS
+  
   def __init__(self):
     TableStat.__init__(
         self,
         "Top messages by size",
         [SubjectSenderFormatter(), SizeFormatter()])
+    
+    # (size, -index) of the largest messages so far, with the smallest of 
+    # them (and the latest, if sizes are the same) first
+    self.__heap = []
+
+  def GetMessagePeriod(self):
+    return ALL_MESSAGES
+
+  def ProcessMessage(self, messages, i):
+    self.__AddEntry((messages.sizes[i], -i))
+
+  def __AddEntry(self, entry):
+    if len(self.__heap) < TableStat._TABLE_SIZE:
+      heapq.heappush(self.__heap, entry)
+    elif entry > self.__heap[0]:
+      heapq.heapreplace(self.__heap, entry)
+
+  def IsIncremental(self):
+    # Entries refer to messages by their index in this run's table
+    return False
 
-  def _GetTableData(self, message_infos, threads):
-    return [(sys.maxint - m.size, m) for m in message_infos]
+  def GetAggregate(self):
+    return self.__heap
+
+  def MergeAggregate(self, heap):
+    for entry in heap:
+      self.__AddEntry(entry)
+
+  def _GetTableData(self, messages, threads):
+    # The index breaks ties between messages of the same size
+    return [
+      (sys.maxint - size, -negative_i, messages[-negative_i]) 
+      for size, negative_i in self.__heap
+    ]
   
   def _GetDisplayData(self, data):
-    return [d[1] for d in data]
+    return [d[2] for d in data]
 
 class ThreadSubjectFormatter(object):
   def __init__(self):
@@ -77,15 +108,16 @@ class ThreadSubjectFormatter(object):
     self.css_class = "subject"
   
   def Format(self, thread):
-    if thread.message and thread.message.message_info:
-      t = Template(
+    message_info = thread.message_info
+    if message_info:
+      t = GetTemplate(
           file="templates/subject-sender-formatter.tmpl",
           searchList = {
-            "message_info": thread.message.message_info,
+            "message_info": message_info,
             "connector": "started by"
           });
     else:
-      t = Template(
+      t = GetTemplate(
           file="templates/subject-formatter.tmpl",
           searchList = {
             "subject": thread.subject,
@@ -99,20 +131,56 @@ class ThreadSizeFormatter(object):
     self.css_class = "length sorting"
   
   def Format(self, thread):
-    return len(thread)
+    return thread.size
+
+class ThreadDepthFormatter(object):
+  def __init__(self):
+    self.header = "Depth"
+    self.css_class = "count"
+
+  def Format(self, thread):
+    return thread.depth
+
+class ThreadParticipantCountFormatter(object):
+  def __init__(self):
+    self.header = "People"
+    self.css_class = "count"
+
+  def Format(self, thread):
+    return thread.participant_count
+
+class ThreadDaysFormatter(object):
+  def __init__(self):
+    self.header = "Days"
+    self.css_class = "count"
+
+  def Format(self, thread):
+    start, end = thread.date_range
+    return "%.1f" % ((end - start)/(24 * 60 * 60))
 
 class ThreadSizeTableStat(TableStat):
+  _HEADER_FIELDS = \
+      messageinfo.DISPLAY_HEADER_FIELDS + messageinfo.SENDER_HEADER_FIELDS
+  
   def __init__(self):
     TableStat.__init__(
         self,
         "Top threads",
-        [ThreadSubjectFormatter(), ThreadSizeFormatter()])
+        [ThreadSubjectFormatter(), ThreadSizeFormatter(),
+            ThreadDepthFormatter(), ThreadParticipantCountFormatter(),
+            ThreadDaysFormatter()])
 
-  def _GetTableData(self, message_infos, threads):
-    return [(sys.maxint - len(t), t) for t in threads]
+  def _GetTableData(self, messages, threads):
+    # Rows are only created for the top threads (the index breaks ties 
+    # between threads of the same size)
+    top_indices = heapq.nlargest(
+        TableStat._TABLE_SIZE, 
+        xrange(len(threads)), 
+        key=threads.sizes.__getitem__)
+    return [(sys.maxint - threads.sizes[i], i, threads[i]) for i in top_indices]
   
   def _GetDisplayData(self, data):
-    return [d[1] for d in data]
+    return [d[2] for d in data]
 
 class ThreadOriginFormatter(object):
   def __init__(self, header, css_class):
@@ -120,7 +188,7 @@ class ThreadOriginFormatter(object):
     self.css_class = css_class
     
   def Format(self, thread_info):
-    t = Template(
+    t = GetTemplate(
         file="templates/address-formatter.tmpl",
         searchList = {
           "address": thread_info["address"],
@@ -154,11 +222,14 @@ class ThreadOriginTableStat(TableStat):
           ThreadOriginSizeFormatter(),
           ThreadCountFormatter()])
  
-  def _GetTableData(self, message_infos, threads):
+  def _GetTableData(self, messages, threads):
     origin_threads = {}
     
-    for thread in threads:
-      origin = self._GetThreadOrigin(thread)
+    for i in xrange(len(threads)):
+      message_index = threads.GetMessageIndex(i)
+      if message_index == -1: continue
+      
+      origin = self._GetThreadOrigin(messages, message_index)
       
       if not origin: continue
 
@@ -178,17 +249,19 @@ class ThreadOriginTableStat(TableStat):
       if origin_name:
         origin_thread_info["name"] = origin_name
       origin_thread_info["count"] += 1
-      origin_thread_info["total_size"] += len(thread)
+      origin_thread_info["total_size"] += threads.sizes[i]
     
-    return [
+    return (
       (sys.maxint - i["total_size"]/i["count"], i) \
           for origin_address, i in origin_threads.items()
-    ]
+    )
    
   def _GetDisplayData(self, data):
     return [d[1] for d in data]  
 
 class ThreadStarterTableStat(ThreadOriginTableStat):
+  _HEADER_FIELDS = messageinfo.SENDER_HEADER_FIELDS
+  
   def __init__(self):
     ThreadOriginTableStat.__init__(
       self,
@@ -196,13 +269,12 @@ class ThreadStarterTableStat(ThreadOriginTableStat):
       "Starter",
       "sender")
   
-  def _GetThreadOrigin(self, thread):
-    if thread.message and thread.message.message_info:
-      return thread.message.message_info.GetSender()
-    else:
-      return None
+  def _GetThreadOrigin(self, messages, i):
+    return messages.GetSender(i)
 
 class ThreadListTableStat(ThreadOriginTableStat):
+  _HEADER_FIELDS = messageinfo.LIST_ID_HEADER_FIELDS
+  
   def __init__(self):
     ThreadOriginTableStat.__init__(
         self,
@@ -210,11 +282,8 @@ class ThreadListTableStat(ThreadOriginTableStat):
         "List",
         "list")
   
-  def _GetThreadOrigin(self, thread):
-    if thread.message and thread.message.message_info:
-      return thread.message.message_info.GetListId()
-    else:
-      return None    
+  def _GetThreadOrigin(self, messages, i):
+    return messages.GetListId(i)
 
 class AddressNameFormatter(object):
   def __init__(self, header, css_class):
@@ -224,7 +293,7 @@ class AddressNameFormatter(object):
   def Format(self, data):
     address, name, count, bytes = data
     
-    t = Template(
+    t = GetTemplate(
         file="templates/address-formatter.tmpl",
         searchList = {
           "address": address,
@@ -253,6 +322,10 @@ class AddressBytesFormatter(object):
     return GetDisplaySize(bytes)    
 
 class UniqueAddressTableStat(TableStat):
+  # If set, addresses are counted approximately, with at most this many 
+  # counters (so that memory use doesn't grow with the number of addresses)
+  counter_budget = None
+  
   def __init__(self, title, column_title, column_css_class):
     TableStat.__init__(
       self,
@@ -262,30 +335,76 @@ class UniqueAddressTableStat(TableStat):
         AddressCountFormatter(),
         AddressBytesFormatter(),
       ])
-  
-  def _GetTableData(self, message_infos, threads):
-    address_counts = {}
-    address_bytes = {}
-    address_names = {}
     
-    for message_info in message_infos:
-      for name, address in self._GetAddresses(message_info):
-        if not address: continue
-        
-        address_counts[address] = address_counts.get(address, 0) + 1
-        address_bytes[address] = \
-            address_bytes.get(address, 0) + message_info.size
-        address_names[address] = name
+    self.__address_counts = {}
+    self.__address_bytes = {}
+    self.__address_names = {}
+    
+    if UniqueAddressTableStat.counter_budget:
+      self.__address_counter = \
+          SpaceSavingCounter(UniqueAddressTableStat.counter_budget)
+    else:
+      self.__address_counter = None
+
+  def GetMessagePeriod(self):
+    return ALL_MESSAGES
+
+  def ProcessMessage(self, messages, i):
+    for name, address in self._GetAddresses(messages, i):
+      if not address: continue
       
-    return [
+      self.__AddAddress(address, name, 1, messages.sizes[i])
+
+  def __AddAddress(self, address, name, count, bytes):
+    address_bytes = self.__address_bytes
+    
+    if self.__address_counter:
+      evicted_address = self.__address_counter.Add(address, count)
+      if evicted_address is not None:
+        del address_bytes[evicted_address]
+        del self.__address_names[evicted_address]
+    else:
+      self.__address_counts[address] = \
+          self.__address_counts.get(address, 0) + count
+    
+    address_bytes[address] = address_bytes.get(address, 0) + bytes
+    self.__address_names[address] = name
+
+  def IsIncremental(self):
+    return True
+
+  def GetAggregate(self):
+    return self.__GetAddressCounts(), self.__address_bytes, \
+        self.__address_names
+
+  def MergeAggregate(self, aggregate):
+    address_counts, address_bytes, address_names = aggregate
+    
+    for address, count in address_counts.items():
+      self.__AddAddress(
+          address, 
+          address_names[address], 
+          count,
+          address_bytes[address])
+
+  def __GetAddressCounts(self):
+    if self.__address_counter:
+      return self.__address_counter.GetCounts()
+    return self.__address_counts
+  
+  def _GetTableData(self, messages, threads):
+    address_bytes = self.__address_bytes
+    address_names = self.__address_names
+    
+    return (
       (
         sys.maxint - count, 
         address, 
         address_names[address],
         address_bytes[address]
       ) 
-      for address, count in address_counts.items()
-    ]
+      for address, count in self.__GetAddressCounts().items()
+    )
   
   def _GetDisplayData(self, data):
     return [
@@ -294,6 +413,8 @@ class UniqueAddressTableStat(TableStat):
    ]
    
 class SenderTableStat(UniqueAddressTableStat):
+  _HEADER_FIELDS = messageinfo.SENDER_HEADER_FIELDS
+  
   def __init__(self):
     UniqueAddressTableStat.__init__(
         self,
@@ -301,10 +422,12 @@ class SenderTableStat(UniqueAddressTableStat):
         "Sender",
         "sender")
   
-  def _GetAddresses(self, message_info):
-    return [message_info.GetSender()]
+  def _GetAddresses(self, messages, i):
+    return [messages.GetSender(i)]
 
 class ListIdTableStat(UniqueAddressTableStat):
+  _HEADER_FIELDS = messageinfo.LIST_ID_HEADER_FIELDS
+  
   def __init__(self):
     UniqueAddressTableStat.__init__(
         self,
@@ -312,10 +435,12 @@ class ListIdTableStat(UniqueAddressTableStat):
         "List",
         "list")
   
-  def _GetAddresses(self, message_info):
-    return [message_info.GetListId()]
+  def _GetAddresses(self, messages, i):
+    return [messages.GetListId(i)]
 
 class RecipientTableStat(UniqueAddressTableStat):
+  _HEADER_FIELDS = messageinfo.RECIPIENT_HEADER_FIELDS
+  
   def __init__(self):
     UniqueAddressTableStat.__init__(
       self,
@@ -323,10 +448,12 @@ class RecipientTableStat(UniqueAddressTableStat):
       "Recipient",
       "recipient")
   
-  def _GetAddresses(self, message_info):
-    return message_info.GetRecipients()
+  def _GetAddresses(self, messages, i):
+    return messages.GetRecipients(i)
     
 class MeRecipientTableStat(UniqueAddressTableStat):
+  _HEADER_FIELDS = messageinfo.RECIPIENT_HEADER_FIELDS
+  
   def __init__(self):
     UniqueAddressTableStat.__init__(
       self,
@@ -334,13 +461,15 @@ class MeRecipientTableStat(UniqueAddressTableStat):
       "Recipient",
       "recipient")
   
-  def _GetAddresses(self, message_info):
-    if message_info.is_from_me:
-      return message_info.GetRecipients()
+  def _GetAddresses(self, messages, i):
+    if messages.IsFromMe(i):
+      return messages.GetRecipients(i)
     else:
       return []
       
 class MeSenderTableStat(UniqueAddressTableStat):
+  _HEADER_FIELDS = messageinfo.SENDER_HEADER_FIELDS
+  
   def __init__(self):
     UniqueAddressTableStat.__init__(
         self,
@@ -348,8 +477,8 @@ class MeSenderTableStat(UniqueAddressTableStat):
         "Sender",
         "sender")
   
-  def _GetAddresses(self, message_info):
-    if message_info.is_to_me:  
-      return [message_info.GetSender()]
+  def _GetAddresses(self, messages, i):
+    if messages.IsToMe(i):  
+      return [messages.GetSender(i)]
     else:
       return []
\ No newline at end of file
@@ -1,51 +1,127 @@
+import re
+
+_ATOM_TERMINATORS = " ()"
+
+_QUOTED_ESCAPE_RE = re.compile(r"\\(.)")
+
 class StringScanner(object):
   def __init__(self, string_chunks):
-    # TODO(mihaip) switch to reading from the chunks array directly to avoid 
-    # extra string copies
-    def flatten(chunks):
-      if type(chunks) == str:
-        return chunks
-      else:
-        chunk_strings = []
-        for chunk in chunks:
-          chunk_strings.append(flatten(chunk))
-        return "".join(chunk_strings)
-    
-    self.__data = flatten(string_chunks)
+    # The chunks (strings, or nested lists and tuples of strings, as returned
+    # by imaplib) are scanned in place, without joining them into one string
+    self.__segments = []
+    self.__AddSegments(string_chunks)
+    
+    self.__segment_index = 0
+    self.__data = self.__segments and self.__segments[0] or ""
     self.__index = 0
     self.__length = len(self.__data)
+  
+  def __AddSegments(self, chunks):
+    if type(chunks) == str:
+      if chunks:
+        self.__segments.append(chunks)
+    else:
+      for chunk in chunks:
+        self.__AddSegments(chunk)
+  
+  def __Seek(self, segment_index, index):
+    self.__segment_index = segment_index
+    self.__data = self.__segments[segment_index]
+    self.__index = index
+    self.__length = len(self.__data)
+  
+  def __NextSegment(self):
+    if self.__segment_index + 1 >= len(self.__segments):
+      return False
+    
+    self.__Seek(self.__segment_index + 1, 0)
+    return True
+  
+  def __AtEnd(self):
+    # Also moves on to the next segment if we're at the end of the current one
+    while self.__index >= self.__length:
+      if not self.__NextSegment():
+        return True
+    return False
     
   def Peek(self):
-    if self.__index >= self.__length: return None
+    if self.__AtEnd(): return None
     return self.__data[self.__index]
   
   def ReadChar(self):
-    if self.__index >= self.__length: return None    
+    if self.__AtEnd(): return None
     c = self.__data[self.__index]
     self.__index += 1
     return c
     
   def ReadUntil(self, c):
+    if self.__AtEnd(): return ""
+    
     start = self.__index
-    end = self.__data.find(c, self.__index)
+    end = self.__data.find(c, start)
     if end != -1:
       self.__index = end
       return self.__data[start:end]
-    else:
-      return ""
+    
+    # The character may be in a later segment
+    start_segment_index = self.__segment_index
+    pieces = [self.__data[start:]]
+    while self.__NextSegment():
+      end = self.__data.find(c)
+      if end != -1:
+        self.__index = end
+        pieces.append(self.__data[:end])
+        return "".join(pieces)
+      pieces.append(self.__data)
+    
+    self.__Seek(start_segment_index, start)
+    return ""
   
   def ConsumeAll(self, c):
-    while self.__index < self.__length and self.__data[self.__index] == c:
+    while not self.__AtEnd() and self.__data[self.__index] == c:
       self.__index += 1
     
   def ConsumeChar(self, c):
-    assert c == self.__data[self.__index]
+    assert c == self.Peek()
     self.__index += 1
     
+  def ReadAtom(self):
+    # Atoms are terminated by a space or by the end of the list that they're in
+    pieces = []
+    while not self.__AtEnd():
+      start = self.__index
+      while self.__index < self.__length and \
+          self.__data[self.__index] not in _ATOM_TERMINATORS:
+        self.__index += 1
+      pieces.append(self.__data[start:self.__index])
+      
+      if self.__index < self.__length:
+        break
+    
+    return "".join(pieces)
+    
   def ReadUntilLength(self, length):
-    ret = self.__data[self.__index:self.__index + length]
-    self.__index += length
-    return ret
+    if self.__AtEnd(): return ""
+    
+    # Literals are normally a segment of their own, in which case they don't
+    # need to be copied
+    if self.__index == 0 and self.__length == length:
+      self.__index = length
+      return self.__data
+    
+    if self.__index + length <= self.__length:
+      ret = self.__data[self.__index:self.__index + length]
+      self.__index += length
+      return ret
+    
+    pieces = []
+    remaining = length
+    while remaining > 0 and not self.__AtEnd():
+      piece = self.__data[self.__index:self.__index + remaining]
+      self.__index += len(piece)
+      remaining -= len(piece)
+      pieces.append(piece)
+    return "".join(pieces)
    
   def ConsumeValue(self):
     value = None
@@ -60,27 +136,40 @@ class StringScanner(object):
       
     # Quoted string 
     elif self.Peek() == "\"":
-      # TODO(mihaip): can quotes be escaped inside?
       self.ConsumeChar("\"")
-      value = self.ReadUntil("\"")
+      
+      # Quotes and backslashes inside are escaped with a backslash
+      pieces = []
+      while True:
+        piece = self.ReadUntil("\"")
+        assert self.Peek() == "\""
+        pieces.append(piece)
+        
+        # An odd number of trailing backslashes means that the quote is 
+        # escaped and we're not at the end of the string yet
+        if (len(piece) - len(piece.rstrip("\\"))) % 2 == 0: break
+        
+        self.ConsumeChar("\"")
+        pieces.append("\"")
+        
       self.ConsumeChar("\"")
+      
+      value = "".join(pieces)
+      if value.find("\\") != -1:
+        value = _QUOTED_ESCAPE_RE.sub(r"\1", value)
     # Parenthesized list 
     elif self.Peek() == "(":
       self.ConsumeChar("(")
       value = []
-      parenthesis_depth = 1
       
-      while parenthesis_depth > 0:
-        c = self.ReadChar()
-        if c == "(": parenthesis_depth += 1
-        if c == ")": parenthesis_depth -= 1
-        
-        if parenthesis_depth > 0:
-          value.append(c)
+      self.ConsumeAll(" ")
+      while self.Peek() != ")":
+        value.append(self.ConsumeValue())
+        self.ConsumeAll(" ")
       
-      value = "".join(value).split()
-    # Numbers
+      self.ConsumeChar(")")
+    # Numbers and other atoms
     else:
-      value = self.ReadUntil(" ")
+      value = self.ReadAtom()
     
     return value
\ No newline at end of file
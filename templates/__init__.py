@@ -0,0 +1,28 @@
+# Templates are compiled into classes the first time that they're used, so that
+# rendering one (which happens once per stat, and once per cell for tables)
+# only needs to fill in its variables.
+
+from Cheetah.Template import Template
+
+_TEMPLATE_CLASSES = {}
+
+def GetTemplate(file, searchList):
+  '''Same as Template(file=file, searchList=searchList), but without 
+  re-reading and recompiling the template file.'''
+  if file not in _TEMPLATE_CLASSES:
+    _TEMPLATE_CLASSES[file] = Template.compile(file=file)
+  return _TEMPLATE_CLASSES[file](searchList=searchList)
+
+class _StreamTransaction(object):
+  '''Cheetah transaction whose response is the stream that output is written
+  to.'''
+  def __init__(self, out):
+    self.__out = out
+
+  def response(self):
+    return self.__out
+
+def WriteTemplate(out, file, searchList):
+  '''Writes a template's output to out as it's generated, instead of building
+  it up as a string first.'''
+  GetTemplate(file, searchList).respond(trans=_StreamTransaction(out))
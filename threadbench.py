@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# Times jwzthreading.thread() on synthetic threads of different shapes and
+# sizes, to check that threading time grows (close to) linearly with the
+# number of messages.
+#
+# Usage: threadbench.py [message_count ...]
+
+import sys
+import time
+
+import jwzthreading
+
+# Mail clients usually truncate References to the first message and the most
+# recent ancestors
+_MAX_REFERENCES = 10
+
+_DEFAULT_MESSAGE_COUNTS = [1000, 2000, 4000, 8000, 16000]
+
+def _MakeMessage(message_id, references, subject):
+  message = jwzthreading.Message()
+  message.message_id = message_id
+  message.references = references
+  message.subject = subject
+  return message
+
+def _TruncateReferences(ancestors):
+  if len(ancestors) <= _MAX_REFERENCES:
+    return ancestors[:]
+  return ancestors[:1] + ancestors[-(_MAX_REFERENCES - 1):]
+
+def MakeDeepThread(count):
+  '''A single chain, with each message replying to the previous one.'''
+  messages = []
+  ancestors = []
+  for i in xrange(count):
+    message_id = "deep%d@example.com" % i
+    messages.append(_MakeMessage(
+        message_id, _TruncateReferences(ancestors), "Re: deep"))
+    ancestors.append(message_id)
+  return messages
+
+def MakeWideThread(count):
+  '''A single message, with all others replying to it.'''
+  messages = [_MakeMessage("wide0@example.com", [], "wide")]
+  for i in xrange(1, count):
+    messages.append(_MakeMessage(
+        "wide%d@example.com" % i, ["wide0@example.com"], "Re: wide"))
+  return messages
+
+def MakeMissingRootThreads(count):
+  '''Replies to messages that were never seen (so that they're dummy
+  containers, which get pruned), with most replies arriving before their
+  parents.'''
+  messages = []
+  for i in reversed(xrange(count)):
+    references = ["missing%d@example.com" % (i / 100)]
+    if i % 10:
+      references.append("missing-reply%d@example.com" % (i - i % 10))
+    messages.append(_MakeMessage(
+        "missing-reply%d@example.com" % i, references, "Re: missing %d" % i))
+  return messages
+
+def MakeManyThreads(count):
+  '''Many small threads, each with a different subject.'''
+  messages = []
+  for i in xrange(count):
+    thread_index = i / 5
+    references = []
+    if i % 5:
+      references = ["many%d@example.com" % (thread_index * 5)]
+    messages.append(_MakeMessage(
+        "many%d@example.com" % i, references, "thread %d" % thread_index))
+  return messages
+
+_SHAPES = [
+  ("deep", MakeDeepThread),
+  ("wide", MakeWideThread),
+  ("missing roots", MakeMissingRootThreads),
+  ("many", MakeManyThreads),
+]
+
+def TimeThreading(messages):
+  start = time.time()
+  jwzthreading.thread(messages)
+  return time.time() - start
+
+def main(argv):
+  message_counts = [int(arg) for arg in argv[1:]] or _DEFAULT_MESSAGE_COUNTS
+
+  print "%-15s %10s %10s %15s" % ("shape", "messages", "seconds", "usec/message")
+  for name, make_messages in _SHAPES:
+    for count in message_counts:
+      seconds = TimeThreading(make_messages(count))
+      print "%-15s %10d %10.3f %15.2f" % (
+          name, count, seconds, seconds * 1000000 / count)
+
+if __name__ == "__main__":
+  main(sys.argv)